@@ -0,0 +1,403 @@
+''' This program will benchmark upload_cdms.py against local stand-ins: mongomock for
+    MongoDB, moto for AWS S3, and SQLite for the SAGE/publishing image_data_mv view.
+    Synthetic neuronMetadata documents and images are generated at the requested scale,
+    and the results (samples/sec and peak memory) are tagged with the git commit so that
+    runs can be compared across commits. mongomock and moto are only needed here, and
+    are installed from requirements-benchmark.txt.
+'''
+__version__ = '1.0.0'
+
+import argparse
+from datetime import datetime
+import json
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from types import SimpleNamespace
+import boto3
+import mongomock
+from moto import mock_aws
+import MySQLdb
+from PIL import Image, ImageDraw
+import requests
+import simple_term_menu
+import jrc_common.jrc_common as JRC
+
+# pylint: disable=broad-exception-caught,logging-fstring-interpolation
+
+BIN = os.path.dirname(os.path.abspath(__file__))
+UPLOAD_CDMS = os.path.join(BIN, 'upload_cdms.py')
+# Benchmark libraries
+LIBRARY = {"flyem": {"library": "flyem_hemibrain_1_2_1", "name": "FlyEM_Hemibrain_v1.2.1",
+                     "alignment": "JRC2018_Unisex_20x_HR", "dataset": "hemibrain:v1.2.1"},
+           "flylight": {"library": "flylight_split_gal4_published",
+                        "name": "FlyLight Split-GAL4 Drivers",
+                        "alignment": "JRC2018_Unisex_20x_HR"}}
+TAG = '3.0'
+RELEASE = 'Benchmark Release'
+BUCKET = {"cdm": "benchmark-cdm", "cdm-thumbnail": "benchmark-cdm-thumbnails"}
+MONGO = mongomock.MongoClient()
+
+
+def terminate_program(msg=None):
+    ''' Terminate the program gracefully
+        Keyword arguments:
+          msg: error message or object
+        Returns:
+          None
+    '''
+    if msg:
+        if not isinstance(msg, str):
+            msg = f"An exception of type {type(msg).__name__} occurred. Arguments:\n{msg.args}"
+        LOGGER.critical(msg)
+    sys.exit(-1 if msg else 0)
+
+
+class SqliteCursor:
+    ''' Stand-in for a MySQLdb DictCursor on a SQLite database '''
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+
+    def execute(self, stmt, args=None):
+        ''' Execute a statement '''
+        return self.cursor.execute(stmt, args or ())
+
+    def fetchall(self):
+        ''' Return all rows as dictionaries '''
+        columns = [col[0] for col in self.cursor.description]
+        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+
+
+class SqliteConnection:
+    ''' Stand-in for a MySQLdb connection to a SQLite database '''
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+
+    def cursor(self, _=None):
+        ''' Return a dictionary cursor '''
+        return SqliteCursor(self.conn)
+
+
+class Response:
+    ''' Stand-in for a configuration server response '''
+    def __init__(self, data):
+        self.status_code = 200
+        self.text = json.dumps(data)
+        self.data = data
+
+    def json(self):
+        ''' Return the response payload '''
+        return self.data
+
+
+class Menu:
+    ''' Stand-in for TerminalMenu that always chooses the last entry ("Yes") '''
+    def __init__(self, entries, **_):
+        self.entries = entries
+
+    def show(self):
+        ''' Return the chosen entry '''
+        return len(self.entries) - 1
+
+
+def get_configuration(workdir):
+    ''' Return the configuration server responses for the benchmark
+        Keyword arguments:
+          workdir: benchmark working directory
+        Returns:
+          Dictionary of configurations keyed by endpoint
+    '''
+    lib = LIBRARY[ARG.TYPE]
+    mysql = {"host": "localhost", "user": "benchmark", "password": "", "name": "benchmark"}
+    return {"config/rest_services": {"config": {"url": "http://config/"},
+                                     "neuprint": {"url": "http://neuprint/"}},
+            "config/aws": {"base_aws_url": "https://s3.amazonaws.com", "role_arn": "",
+                           "s3_bucket": BUCKET},
+            "config/upload_cdms": {"variants": ["searchable_neurons", "gradient", "zgap"],
+                                   "drivers": ["GAL4", "LexA", "Split_GAL4"],
+                                   "published_col": ["_id", "libraryName", "alignmentSpace",
+                                                     "publishedName", "slideCode", "gender",
+                                                     "objective", "anatomicalArea",
+                                                     "uploaded"],
+                                   "skeletons": ["SWCSkeleton"],
+                                   "temp_dir": os.path.join(workdir, 'temp') + '/',
+                                   "version_required": []},
+            "config/cdm_library": {lib['library']: {"name": lib['name']}},
+            "config/db_config": {"sage": {"prod": mysql}, "mbew": {"prod": mysql}},
+            "dbmeta/datasets": {lib.get('dataset', 'none:v0'): {}}}
+
+
+def install_stand_ins(workdir):
+    ''' Replace the external services used by upload_cdms with local stand-ins
+        Keyword arguments:
+          workdir: benchmark working directory
+        Returns:
+          moto mock (to be stopped when the benchmark is done)
+    '''
+    config = get_configuration(workdir)
+    def get(url, **_):
+        for endpoint, data in config.items():
+            if url.endswith(endpoint):
+                return Response({"config": data} if endpoint.startswith('config/') else data)
+        return Response({})
+    requests.get = get
+    dbconfig = SimpleNamespace()
+    for source in ('jacs', 'neuronbridge'):
+        dbo = SimpleNamespace(name=source, host='mongomock', user='benchmark')
+        setattr(dbconfig, source, SimpleNamespace(prod=SimpleNamespace(read=dbo, write=dbo)))
+    JRC.get_config = lambda _: dbconfig
+    JRC.connect_database = lambda dbo: MONGO[dbo.name]
+    JRC.check_token = lambda _: {"payload": {"full_name": "Benchmark"}}
+    os.environ['CONFIG_SERVER_URL'] = 'http://config/'
+    for tok in ['JACS_JWT', 'NEUPRINT_JWT']:
+        os.environ[tok] = 'benchmark'
+    sage = os.path.join(workdir, 'sage.db')
+    MySQLdb.connect = lambda **_: SqliteConnection(sage)
+    simple_term_menu.TerminalMenu = Menu
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+        os.environ[var] = 'benchmark'
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+    mock = mock_aws()
+    mock.start()
+    s3_client = boto3.client('s3')
+    for bucket in BUCKET.values():
+        s3_client.create_bucket(Bucket=f"{bucket}-dev")
+    return mock
+
+
+def make_image(path, seed):
+    ''' Write a synthetic color depth MIP: a black image with colored neuron-like
+        strokes, which compresses like the real thing
+        Keyword arguments:
+          path: file path (the extension sets the format)
+          seed: random seed
+        Returns:
+          None
+    '''
+    rng = random.Random(seed)
+    image = Image.new('RGB', (ARG.WIDTH, ARG.HEIGHT))
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        points = [(rng.randrange(ARG.WIDTH), rng.randrange(ARG.HEIGHT)) for _ in range(6)]
+        draw.line(points, fill=tuple(rng.randrange(256) for _ in range(3)),
+                  width=rng.randrange(1, 6))
+    image.save(path)
+
+
+def generate_images(workdir):
+    ''' Generate the pool of synthetic images. Samples share --distinct images, so
+        that large benchmarks don't spend most of their time writing images.
+        Keyword arguments:
+          workdir: benchmark working directory
+        Returns:
+          List of dictionaries of image paths by kind
+    '''
+    imgdir = os.path.join(workdir, 'images')
+    os.makedirs(imgdir)
+    os.makedirs(os.path.join(workdir, 'temp'))
+    pool = []
+    for idx in range(ARG.DISTINCT):
+        if ARG.TYPE == 'flyem':
+            paths = {"SourceColorDepthImage": f"{imgdir}/{idx}_cdm.tif",
+                     "InputColorDepthImage": f"{imgdir}/{idx}_sn.tif",
+                     "GradientImage": f"{imgdir}/{idx}_grad.tif",
+                     "SWCSkeleton": f"{imgdir}/{idx}.swc"}
+        else:
+            paths = {"SourceColorDepthImage": f"{imgdir}/{idx}-CH1_cdm.png",
+                     "InputColorDepthImage": f"{imgdir}/{idx}-CH1-01.tif",
+                     "GradientImage": f"{imgdir}/{idx}-CH1-02.tif"}
+        for kind, path in paths.items():
+            if kind == 'SWCSkeleton':
+                with open(path, 'w', encoding='ascii') as outstream:
+                    outstream.write("1 1 0.0 0.0 0.0 1.0 -1\n")
+            else:
+                make_image(path, f"{idx}{kind}")
+        pool.append(paths)
+    return pool
+
+
+def generate_samples(workdir, pool):
+    ''' Generate the neuronMetadata documents, and the publishing tables they need
+        Keyword arguments:
+          workdir: benchmark working directory
+          pool: synthetic images
+        Returns:
+          None
+    '''
+    lib = LIBRARY[ARG.TYPE]
+    nbdb = MONGO['neuronbridge']
+    nbdb.lmRelease.insert_one({"release": RELEASE, "public": True})
+    if ARG.TYPE == 'flyem':
+        name, version = lib['dataset'].split(':v')
+        MONGO['jacs'].emDataSet.insert_one({"name": name, "version": version})
+    sage = sqlite3.connect(os.path.join(workdir, 'sage.db'))
+    sage.execute("CREATE TABLE image_data_mv (publishing_name TEXT, driver TEXT, " \
+                 + "workstation_sample_id TEXT, alps_release TEXT, slide_code TEXT)")
+    docs = []
+    rows = []
+    for idx in range(ARG.SAMPLES):
+        sid = str(2000000000000000000 + idx)
+        doc = {"_id": 1000000 + idx, "libraryName": lib['library'],
+               "alignmentSpace": lib['alignment'], "tags": [TAG],
+               "computeFiles": pool[idx % len(pool)]}
+        if ARG.TYPE == 'flyem':
+            doc.update({"publishedName": str(100000 + idx), "sourceRefId": f"EMBody#{idx}"})
+        else:
+            line = f"SS{idx // 4:05d}"
+            slide = f"20240101_{idx:06d}_A1"
+            doc.update({"publishedName": line, "sourceRefId": f"Sample#{sid}",
+                        "slideCode": slide, "gender": "f", "objective": "40x",
+                        "anatomicalArea": "Brain"})
+            rows.append((line, "Split_GAL4", sid, RELEASE, slide))
+        docs.append(doc)
+    nbdb.neuronMetadata.insert_many(docs)
+    if rows:
+        sage.executemany("INSERT INTO image_data_mv VALUES (?,?,?,?,?)", rows)
+        nbdb.publishedLMImage.insert_many([{"sampleRef": f"Sample#{row[2]}"} for row in rows])
+    sage.commit()
+    sage.close()
+
+
+def run_upload_cdms(workdir, extra):
+    ''' Run upload_cdms.py (in this process, so that it uses the stand-ins) on the
+        benchmark library
+        Keyword arguments:
+          workdir: benchmark working directory
+          extra: additional upload_cdms arguments
+        Returns:
+          upload_cdms module, elapsed seconds
+    '''
+    lib = LIBRARY[ARG.TYPE]
+    batch = os.path.join(workdir, 'batch.txt')
+    with open(batch, 'w', encoding='ascii') as outstream:
+        outstream.write(f"{lib['library']} {lib['alignment']} {TAG}\n")
+    sys.argv = [UPLOAD_CDMS, '--batch', batch, '--manifold', 'dev', '--write', '--aws',
+                '--metrics', os.path.join(workdir, 'metrics')] + extra
+    # The upload_cdms functions must be importable for its conversion processes, so
+    # import it and run its main()
+    sys.path.insert(0, BIN)
+    import upload_cdms # pylint: disable=import-outside-toplevel
+    start = perf_counter()
+    try:
+        upload_cdms.main()
+    except SystemExit as err:
+        if err.code:
+            terminate_program(f"upload_cdms.py exited with status {err.code}")
+    return upload_cdms, perf_counter() - start
+
+
+def git_commit():
+    ''' Return the current git commit (with a suffix if the tree has changes)
+        Keyword arguments:
+          None
+        Returns:
+          Commit hash
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BIN, check=True,
+                                capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=BIN, check=True, capture_output=True, text=True).stdout
+    except Exception as err:
+        LOGGER.warning(f"Could not get git commit: {err}")
+        return 'unknown'
+    return commit + ('-dirty' if dirty.strip() else '')
+
+
+def peak_memory():
+    ''' Return the peak resident set size of this process and of its (conversion)
+        child processes
+        Keyword arguments:
+          None
+        Returns:
+          Peak RSS in MB for self and children
+    '''
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+
+def run_benchmark(extra):
+    ''' Set up the stand-ins and synthetic data, run upload_cdms, and report the results
+        Keyword arguments:
+          extra: additional upload_cdms arguments
+        Returns:
+          None
+    '''
+    workdir = tempfile.mkdtemp(prefix='benchmark_upload_cdms_')
+    cwd = os.getcwd()
+    output = os.path.abspath(ARG.OUTPUT)
+    LOGGER.info(f"Working directory is {workdir}")
+    mock = install_stand_ins(workdir)
+    stime = perf_counter()
+    pool = generate_images(workdir)
+    generate_samples(workdir, pool)
+    LOGGER.info(f"Generated {ARG.SAMPLES:,} samples in {perf_counter() - stime:.2f}sec")
+    os.chdir(workdir)
+    try:
+        program, elapsed = run_upload_cdms(workdir, extra)
+    finally:
+        os.chdir(cwd)
+        mock.stop()
+    peak = peak_memory()
+    with open(os.path.join(workdir, 'metrics.json'), 'r', encoding='ascii') as instream:
+        metrics = json.load(instream)
+    samples = program.COUNT['Samples']
+    result = {"commit": git_commit(), "date": datetime.now().isoformat(timespec='seconds'),
+              "type": ARG.TYPE, "samples": samples, "images": ARG.DISTINCT,
+              "width": ARG.WIDTH, "height": ARG.HEIGHT, "arguments": extra,
+              "elapsed": round(elapsed, 3),
+              "samples_per_second": round(samples / elapsed, 3) if elapsed else 0,
+              "peak_rss_mb": round(peak[0], 1), "peak_child_rss_mb": round(peak[1], 1),
+              "uploads": program.COUNT['Amazon S3 uploads'],
+              "stages": {stage: {"count": stat['count'], "seconds": round(stat['seconds'], 3),
+                                 "bytes": stat['bytes']}
+                         for stage, stat in metrics['stages'].items()}}
+    print(f"Commit:              {result['commit']}")
+    print(f"Samples:             {samples:,} ({ARG.TYPE})")
+    print(f"Elapsed time:        {elapsed:,.2f}sec")
+    print(f"Samples/sec:         {result['samples_per_second']:,.2f}")
+    print(f"Peak memory:         {peak[0]:,.1f}MB (conversion processes {peak[1]:,.1f}MB)")
+    with open(output, 'a', encoding='ascii') as outstream:
+        outstream.write(json.dumps(result) + "\n")
+    LOGGER.info(f"Appended results to {output}")
+    if not ARG.KEEP:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    PARSER = argparse.ArgumentParser(
+        description="Benchmark upload_cdms.py on synthetic data. Unrecognized " \
+                    + "arguments (e.g. --workers 16) are passed to upload_cdms.py.")
+    PARSER.add_argument('--type', dest='TYPE', action='store',
+                        default='flyem', choices=['flyem', 'flylight'],
+                        help='Library type [flyem, flylight]')
+    PARSER.add_argument('--samples', dest='SAMPLES', action='store', type=int,
+                        default=1000, help='Number of neuronMetadata samples')
+    PARSER.add_argument('--distinct', dest='DISTINCT', action='store', type=int,
+                        default=20, help='Number of distinct synthetic images of each kind')
+    PARSER.add_argument('--width', dest='WIDTH', action='store', type=int,
+                        default=1210, help='Image width')
+    PARSER.add_argument('--height', dest='HEIGHT', action='store', type=int,
+                        default=566, help='Image height')
+    PARSER.add_argument('--output', dest='OUTPUT', action='store',
+                        default='benchmark_upload_cdms.jsonl', help='Results file (appended)')
+    PARSER.add_argument('--keep', dest='KEEP', action='store_true',
+                        default=False, help='Flag, Keep the working directory')
+    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+                        default=False, help='Flag, Chatty')
+    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+                        default=False, help='Flag, Very chatty')
+    ARG, EXTRA = PARSER.parse_known_args()
+    LOGGER = JRC.setup_logging(ARG)
+    if min(ARG.SAMPLES, ARG.DISTINCT) < 1:
+        terminate_program("--samples and --distinct must be at least 1")
+    run_benchmark(EXTRA)
+    terminate_program()
@@ -4,12 +4,24 @@
 
 import argparse
 import collections
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+import gzip
+from itertools import chain, islice
+import json
 from operator import attrgetter
+import os
+import queue
+import random
 import re
 import sys
+import threading
 import time
 import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, \
+                               HTTPClientError
 import inquirer
 from inquirer.themes import BlueComposure
 import MySQLdb
@@ -21,12 +33,24 @@ import neuronbridge_common.neuronbridge_common as NB
 # Configuration
 NEURON_DATA = ["neuronInstance", "neuronType"]
 NEURON_MAP = {}
+NEURON_BODIES = {} # Bodies by neuron (keyed by neuronInstance)
 TYPE_BODY_LIMIT = 10000
 ARG = LOGGER = None
 # Database
 DATABASE = {}
 DYNAMO = {}
 ITEMS = []
+# DynamoDB writer (the rate is in write capacity units per second)
+DDB_BATCH = 25
+DDB_RETRIES = 15
+THROTTLE_CODES = ['ProvisionedThroughputExceededException', 'ThrottlingException',
+                  'RequestLimitExceeded']
+# Transient server errors (HTTP 5xx) are retried without slowing down
+RETRY_CODES = ['InternalServerError', 'ServiceUnavailable']
+SERIALIZER = TypeSerializer()
+DESERIALIZER = TypeDeserializer()
+WRITER = {'lock': threading.Lock(), 'rate': 0.0, 'allowance': 0.0, 'last': 0.0, 'cut': 0.0,
+          'capacity': 0.0}
 # Counters
 COUNT = collections.defaultdict(lambda: 0, {})
 FAILURE = {}
@@ -80,6 +104,19 @@ def create_dynamodb_table(dynamodb, table):
         table.wait_until_exists()
 
 
+def versioned_table(version):
+    ''' Return the name of the DynamoDB table for a version (and manifold)
+        Keyword arguments:
+          version: DynamoDB NeuronBridge version
+        Returns:
+          Table name
+    '''
+    table = "janelia-neuronbridge-published-" + version
+    if ARG.MANIFOLD != "prod":
+        table += f"-{ARG.MANIFOLD}"
+    return table
+
+
 def initialize_program():
     """ Initialize the program
         Keyword arguments:
@@ -108,20 +145,33 @@ def initialize_program():
     if ARG.DDBVERSION:
         if not re.match(r"v\d+(?:\.\d+)+", ARG.DDBVERSION):
             terminate_program(f"{ARG.DDBVERSION} is not a valid version")
-        table = "janelia-neuronbridge-published-" + ARG.DDBVERSION
     else:
         ver = ARG.VERSION
         if not ver.startswith("v"):
             ver = f"v{ARG.VERSION}"
         ARG.DDBVERSION = ver
-        table = "janelia-neuronbridge-published-" + ver
-    if ARG.MANIFOLD != "prod":
-        table += f"-{ARG.MANIFOLD}"
+    table = versioned_table(ARG.DDBVERSION)
+    if ARG.CLONE_FROM:
+        if not re.match(r"v\d+(?:\.\d+)+", ARG.CLONE_FROM):
+            terminate_program(f"{ARG.CLONE_FROM} is not a valid version")
+        if ARG.CLONE_FROM == ARG.DDBVERSION:
+            terminate_program("Can't clone a version into itself")
+    if ARG.OUTPUT:
+        # The items only go to a file, so there's no need to connect to DynamoDB
+        LOGGER.info("Will write results to %s", ARG.OUTPUT)
+        return
     try:
         dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-        dynamodb_client = boto3.client('dynamodb', region_name='us-east-1')
+        dynamodb_client = boto3.client('dynamodb', region_name='us-east-1',
+                                       config=Config(max_pool_connections=max(10, ARG.WRITERS)))
+        # Errors aren't retried by botocore, so that the writer's controller sees
+        # throttling (write_batch retries throttling and server errors itself)
+        config = Config(max_pool_connections=max(10, ARG.WRITERS),
+                        retries={'mode': 'standard', 'max_attempts': 1})
+        DYNAMO['writer'] = boto3.client('dynamodb', region_name='us-east-1', config=config)
     except Exception as err:
         terminate_program(err)
+    DYNAMO['client'] = dynamodb_client
     try:
         _ = dynamodb_client.describe_table(TableName=table)
     except dynamodb_client.exceptions.ResourceNotFoundException:
@@ -131,10 +181,18 @@ def initialize_program():
     DATABASE["DYN"] = dynamodb.Table(table)
     try:
         ddt = dynamodb_client.describe_table(TableName=table)
-        DYNAMO['client'] = dynamodb_client
         DYNAMO['arn'] = ddt['Table']['TableArn']
     except dynamodb_client.exceptions.ResourceNotFoundException:
         LOGGER.warning("Table %s doesn't exist", table)
+    if ARG.CLONE_FROM:
+        DYNAMO['source'] = versioned_table(ARG.CLONE_FROM)
+        try:
+            ddt = dynamodb_client.describe_table(TableName=DYNAMO['source'])
+        except dynamodb_client.exceptions.ResourceNotFoundException:
+            terminate_program(f"Table {DYNAMO['source']} doesn't exist")
+        DYNAMO['source_arn'] = ddt['Table']['TableArn']
+        DYNAMO['source_count'] = ddt['Table']['ItemCount']
+        LOGGER.info(f"Will clone DynamoDB table {DYNAMO['source']}")
 
 
 def get_release(slide_code):
@@ -246,6 +304,55 @@ def primary_update(rlist):
         update_ddb_nb(row["libraryName"])
 
 
+def map_neuron_bodies(ntype, names):
+    ''' Map each neuron to the bodies in this version. Neurons are counted first, and
+        bodies are then only collected for the requested neurons within TYPE_BODY_LIMIT
+        (add_neuron skips the others). With --delta, every neuron in the version is
+        counted, since still_published needs the full set.
+        Keyword arguments:
+          ntype: "neuronInstance"
+          names: neurons being published
+        Returns:
+          None
+    '''
+    LOGGER.info(f"Mapping {ntype} bodies")
+    names = list(names)
+    coll = DATABASE["NB"]["neuronMetadata"]
+    NEURON_BODIES[ntype] = {}
+    if ARG.DELTA:
+        payload = [{"$match": {"tags": ARG.VERSION, ntype: {"$exists": 1}}},
+                   {"$unwind": f"${ntype}"},
+                   {"$match": {ntype: {"$ne": ""}}}]
+    else:
+        payload = [{"$match": {"tags": ARG.VERSION, ntype: {"$in": names}}},
+                   {"$unwind": f"${ntype}"},
+                   {"$match": {ntype: {"$in": names}}}]
+    payload.append({"$group": {"_id": f"${ntype}", "count": {"$sum": 1}}})
+    try:
+        rows = coll.aggregate(payload, allowDiskUse=True)
+        for row in rows:
+            NEURON_BODIES[ntype][row["_id"]] = {"count": row["count"], "bodies": []}
+    except Exception as err:
+        terminate_program(err)
+    small = [name for name in names if name in NEURON_BODIES[ntype]
+             and NEURON_BODIES[ntype][name]["count"] <= TYPE_BODY_LIMIT]
+    if small:
+        payload = [{"$match": {"tags": ARG.VERSION, ntype: {"$in": small}}},
+                   {"$unwind": f"${ntype}"},
+                   {"$match": {ntype: {"$in": small}}},
+                   {"$group": {"_id": f"${ntype}",
+                               "bodies": {"$push": {"publishedName": "$publishedName",
+                                                    "datasetLabels": "$datasetLabels"}}}}
+                  ]
+        try:
+            rows = coll.aggregate(payload, allowDiskUse=True)
+            for row in tqdm(rows, desc=f"Adding {ntype} bodies", total=len(small)):
+                NEURON_BODIES[ntype][row["_id"]]["bodies"] = row["bodies"]
+        except Exception as err:
+            terminate_program(err)
+    LOGGER.info(f"Neurons mapped ({ntype}): {len(NEURON_BODIES[ntype]):,}")
+
+
 def add_neuron(neuron, ntype):
     ''' Add a single neuron (Instance) to the list of items to be stored in DynamoDB
         Keyword arguments:
@@ -254,18 +361,14 @@ def add_neuron(neuron, ntype):
         Returns:
           None
     '''
-    coll = DATABASE["NB"]["neuronMetadata"]
     # Allow a body ID from any library
-    #payload = {ntype: neuron, "libraryName": row["libraryName"]}
-    payload = {ntype: neuron, "tags": ARG.VERSION}
-    cnt = coll.count_documents(payload)
+    mapped = NEURON_BODIES[ntype].get(neuron, {"count": 0, "bodies": []})
+    cnt = mapped["count"]
     if cnt > TYPE_BODY_LIMIT:
         LOGGER.warning(f"{cnt:,} bodies for {ntype} {neuron}")
         return
-    results = coll.find(payload, {"publishedName": 1, "tags": 1,
-                                  "libraryName": 1, "datasetLabels": 1})
     bids = {}
-    for brow in results:
+    for brow in mapped["bodies"]:
         if 'datasetLabels' not in brow:
             print(brow)
             terminate_program(f"No dataset labels for {brow['publishedName']} {neuron}")
@@ -340,6 +443,8 @@ def update_neuron_matches(neurons):
           None
     '''
     for ntype in NEURON_DATA:
+        if ntype != "neuronType" and neurons[ntype]:
+            map_neuron_bodies(ntype, neurons[ntype])
         for neuron in tqdm(neurons[ntype], desc=ntype):
             if ntype == "neuronType":
                 add_neuron_type(neuron)
@@ -347,20 +452,543 @@ def update_neuron_matches(neurons):
                 add_neuron(neuron, ntype)
 
 
-def write_dynamodb():
-    ''' Write rows from ITEMS to DynamoDB in batch
+def put_request(item):
+    ''' Return a batch write request to put an item
+        Keyword arguments:
+          item: DynamoDB item
+        Returns:
+          Request
+    '''
+    return {"PutRequest": {"Item": {key: SERIALIZER.serialize(val)
+                                    for key, val in item.items()}}}
+
+
+def delete_request(item):
+    ''' Return a batch write request to delete an item
+        Keyword arguments:
+          item: DynamoDB item (only the key is used)
+        Returns:
+          Request
+    '''
+    return {"DeleteRequest": {"Key": {key: SERIALIZER.serialize(item[key])
+                                      for key in ("itemType", "searchKey")}}}
+
+
+def acquire_capacity(units):
+    ''' Wait until the writer's token bucket has enough capacity for a batch. The
+        bucket refills at the current write rate, and holds at most one second of it.
+        Keyword arguments:
+          units: write capacity units needed
+        Returns:
+          None
+    '''
+    while True:
+        with WRITER['lock']:
+            now = time.perf_counter()
+            WRITER['allowance'] = min(max(WRITER['rate'], units), WRITER['allowance'] \
+                                      + (now - WRITER['last']) * WRITER['rate'])
+            WRITER['last'] = now
+            if WRITER['allowance'] >= units:
+                WRITER['allowance'] -= units
+                return
+            delay = (units - WRITER['allowance']) / WRITER['rate']
+        time.sleep(delay)
+
+
+def adjust_rate(throttled, units=0, consumed=0):
+    ''' Adjust the write rate after a batch (additive increase, multiplicative decrease).
+        Items larger than 1KB use more than one capacity unit, so the difference between
+        the consumed and estimated capacity is charged to the bucket.
+        Keyword arguments:
+          throttled: True if the batch was throttled or had unprocessed items
+          units: estimated write capacity units
+          consumed: consumed write capacity units
+        Returns:
+          None
+    '''
+    with WRITER['lock']:
+        WRITER['capacity'] += consumed
+        if consumed > units:
+            WRITER['allowance'] -= consumed - units
+        if throttled:
+            COUNT['throttled'] += 1
+            # Concurrent writers are throttled together, so only back off once a second
+            now = time.perf_counter()
+            if now - WRITER['cut'] > 1:
+                WRITER['rate'] = min(WRITER['ceiling'], max(DDB_BATCH, WRITER['rate'] / 2))
+                WRITER['cut'] = now
+                LOGGER.debug(f"Throttled - write rate is now {WRITER['rate']:,.0f} WCU/sec")
+        elif WRITER['rate'] < WRITER['ceiling']:
+            WRITER['rate'] = min(WRITER['ceiling'], WRITER['rate'] + DDB_BATCH / 10)
+
+
+def write_batch(table, batch):
+    ''' Write a batch of up to 25 requests, retrying throttled requests, server errors,
+        and unprocessed items with exponential backoff. This runs in a writer thread.
+        Keyword arguments:
+          table: DynamoDB table name
+          batch: list of put/delete requests
+        Returns:
+          None
+    '''
+    remaining = batch
+    for attempt in range(DDB_RETRIES):
+        sent = len(remaining)
+        acquire_capacity(sent)
+        try:
+            resp = DYNAMO['writer'].batch_write_item(RequestItems={table: remaining},
+                                                     ReturnConsumedCapacity='TOTAL')
+        except ClientError as err:
+            code = err.response['Error']['Code']
+            if code in THROTTLE_CODES:
+                adjust_rate(True)
+            elif code in RETRY_CODES \
+                 or err.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+                LOGGER.warning(f"Retrying batch write after {err}")
+            else:
+                raise
+        except (BotoConnectionError, HTTPClientError) as err:
+            LOGGER.warning(f"Retrying batch write after {err}")
+        else:
+            consumed = sum(cap.get('CapacityUnits', 0)
+                           for cap in resp.get('ConsumedCapacity', []))
+            remaining = resp.get('UnprocessedItems', {}).get(table, [])
+            adjust_rate(bool(remaining), sent, consumed)
+            if not remaining:
+                break
+        time.sleep(min(20, 0.05 * 2 ** attempt) * random.uniform(0.5, 1))
+    else:
+        raise RuntimeError(f"Could not write {len(remaining)} items after {DDB_RETRIES} tries")
+    with WRITER['lock']:
+        for req in batch:
+            COUNT["insertions" if "PutRequest" in req else "deletions"] += 1
+
+
+def finish_batches(pending, progress, return_when=ALL_COMPLETED):
+    ''' Wait for batch writes in flight. Batches complete out of order, so the number
+        of requests written without gaps from the start is also tracked.
+        Keyword arguments:
+          pending: dictionary of futures -> (batch number, number of requests)
+          progress: progress dictionary (progress bar, completed batches, and position)
+          return_when: ALL_COMPLETED to wait for all batches, FIRST_COMPLETED to free a writer
+        Returns:
+          Exception from a failed batch (or None)
+    '''
+    if not pending:
+        return None
+    failed = None
+    done, _ = wait(pending, return_when=return_when)
+    for future in done:
+        seq, count = pending.pop(future)
+        progress['pbar'].update(count)
+        err = future.exception()
+        if err:
+            failed = failed or err
+            continue
+        progress['done'][seq] = count
+    while progress['next'] in progress['done']:
+        progress['written'] += progress['done'].pop(progress['next'])
+        progress['next'] += 1
+    return failed
+
+
+def write_requests(reqs, total=None, desc="DynamoDB", checkpoint=None):
+    ''' Write put and delete requests to DynamoDB with --writers concurrent batch streams.
+        The write rate starts low and adapts to throttling and unprocessed items, up to
+        the --max-wcu ceiling.
+        Keyword arguments:
+          reqs: iterable of put/delete requests
+          total: number of requests (for the progress bar)
+          desc: progress bar description
+          checkpoint: function called (every few seconds, and at the end) with the
+                      number of requests written without gaps from the start
+        Returns:
+          None
+    '''
+    table = DATABASE["DYN"].name
+    ceiling = ARG.MAX_WCU if ARG.MAX_WCU else float('inf')
+    WRITER.update({'ceiling': ceiling, 'rate': min(ceiling, DDB_BATCH * ARG.WRITERS),
+                   'allowance': 0.0, 'last': time.perf_counter(), 'cut': 0.0, 'capacity': 0.0})
+    start = time.perf_counter()
+    reqs = iter(reqs)
+    pending = {}
+    saved = start
+    failed = None
+    with ThreadPoolExecutor(max_workers=ARG.WRITERS, thread_name_prefix='writer') as executor, \
+         tqdm(total=total, desc=desc) as pbar:
+        progress = {'pbar': pbar, 'done': {}, 'next': 0, 'written': 0}
+        for seq in range(sys.maxsize):
+            batch = list(islice(reqs, DDB_BATCH))
+            if not batch:
+                break
+            while len(pending) >= ARG.WRITERS * 4:
+                failed = finish_batches(pending, progress, FIRST_COMPLETED)
+                if failed:
+                    break
+                if checkpoint and time.perf_counter() - saved > 5:
+                    checkpoint(progress['written'])
+                    saved = time.perf_counter()
+            if failed:
+                break
+            pending[executor.submit(write_batch, table, batch)] = (seq, len(batch))
+        failed = finish_batches(pending, progress) or failed
+    if checkpoint:
+        checkpoint(progress['written'])
+    if failed:
+        terminate_program(failed)
+    elapsed = time.perf_counter() - start
+    LOGGER.info(f"Wrote {pbar.n:,} requests in {elapsed:,.2f}sec " \
+                + f"({pbar.n / elapsed if elapsed else 0:,.1f}/sec), consumed " \
+                + f"{WRITER['capacity']:,.1f} WCU, final rate {WRITER['rate']:,.0f} WCU/sec")
+
+
+def item_key(item):
+    ''' Return the primary key of an item
+        Keyword arguments:
+          item: DynamoDB item
+        Returns:
+          (itemType, searchKey) tuple
+    '''
+    return (item["itemType"], item["searchKey"])
+
+
+def scan_segment(table, segment, segments, item_type="searchString", deserialize=True):
+    ''' Yield the pages of items from one segment of a (consistent) parallel scan
+        Keyword arguments:
+          table: DynamoDB table name
+          segment: segment number
+          segments: total number of segments
+          item_type: itemType to return (None for all items)
+          deserialize: convert items from DynamoDB's attribute value format
+        Returns:
+          Generator of lists of items
+    '''
+    payload = {"TableName": table, "Segment": segment, "TotalSegments": segments,
+               "ConsistentRead": True}
+    if item_type:
+        payload["FilterExpression"] = "itemType = :itype"
+        payload["ExpressionAttributeValues"] = {":itype": {"S": item_type}}
+    while True:
+        resp = DYNAMO['client'].scan(**payload)
+        if not deserialize:
+            yield resp['Items']
+        else:
+            yield [{key: DESERIALIZER.deserialize(val) for key, val in item.items()}
+                   for item in resp['Items']]
+        if 'LastEvaluatedKey' not in resp:
+            return
+        payload['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def scan_table(table):
+    ''' Read the searchString items in a table with a parallel scan (one segment
+        per writer)
+        Keyword arguments:
+          table: DynamoDB table name
+        Returns:
+          Dictionary of items keyed by primary key
+    '''
+    current = {}
+    def read_segment(segment):
+        found = 0
+        for page in scan_segment(table, segment, ARG.WRITERS):
+            with WRITER['lock']:
+                for item in page:
+                    current[item_key(item)] = item
+            found += len(page)
+        return found
+    LOGGER.info(f"Scanning {table} with {ARG.WRITERS} segments")
+    try:
+        with ThreadPoolExecutor(max_workers=ARG.WRITERS, thread_name_prefix='scan') as executor:
+            list(executor.map(read_segment, range(ARG.WRITERS)))
+    except DYNAMO['client'].exceptions.ResourceNotFoundException:
+        LOGGER.warning(f"Table {table} doesn't exist")
+    except Exception as err:
+        terminate_program(err)
+    return current
+
+
+def scanned_items(table):
+    ''' Yield every item in a table (in DynamoDB's attribute value format). The table
+        is read with a parallel scan by one thread per writer, into a bounded queue.
+        Keyword arguments:
+          table: DynamoDB table name
+        Returns:
+          Generator of items
+    '''
+    pages = queue.Queue(maxsize=ARG.WRITERS * 4)
+    def read_segment(segment):
+        try:
+            for page in scan_segment(table, segment, ARG.WRITERS, None, False):
+                pages.put(page)
+        except Exception as err:
+            pages.put(err)
+            return
+        pages.put(None)
+    for segment in range(ARG.WRITERS):
+        threading.Thread(target=read_segment, args=(segment,), name=f"scan_{segment}",
+                         daemon=True).start()
+    finished = 0
+    while finished < ARG.WRITERS:
+        page = pages.get()
+        if page is None:
+            finished += 1
+        elif isinstance(page, Exception):
+            terminate_program(page)
+        else:
+            yield from page
+
+
+def clone_requests():
+    ''' Yield put requests for every item in the --clone-from version's table. With
+        --delta, the searchString items are also kept in DYNAMO['cloned'], so that the
+        table doesn't need to be scanned again.
+        Keyword arguments:
+          None
+        Returns:
+          Generator of requests
+    '''
+    if ARG.DELTA:
+        DYNAMO['cloned'] = {}
+    for item in scanned_items(DYNAMO['source']):
+        if ARG.DELTA and item.get("itemType") == {"S": "searchString"}:
+            plain = {key: DESERIALIZER.deserialize(val) for key, val in item.items()}
+            DYNAMO['cloned'][item_key(plain)] = plain
+        yield {"PutRequest": {"Item": item}}
+
+
+def clone_table():
+    ''' Copy every item (and the library tags) from the --clone-from version's table
+        into this version's table
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not ARG.WRITE:
+        LOGGER.warning(f"Would clone about {DYNAMO['source_count']:,} items from " \
+                       + f"{DYNAMO['source']}")
+        return
+    LOGGER.info(f"Cloning {DYNAMO['source']} into {DATABASE['DYN'].name}")
+    # ItemCount is only updated every six hours, so the progress bar is approximate
+    write_requests(clone_requests(), DYNAMO['source_count'], "Clone")
+    COUNT["cloned"], COUNT["insertions"] = COUNT["insertions"], 0
+    tags = []
+    payload = {"ResourceArn": DYNAMO['source_arn']}
+    try:
+        while True:
+            resp = DYNAMO['client'].list_tags_of_resource(**payload)
+            tags.extend(tag for tag in resp['Tags'] if " - " in tag['Key'])
+            if 'NextToken' not in resp:
+                break
+            payload['NextToken'] = resp['NextToken']
+        for idx in range(0, len(tags), 50):
+            DYNAMO['client'].tag_resource(ResourceArn=DYNAMO['arn'], Tags=tags[idx:idx + 50])
+    except Exception as err:
+        LOGGER.warning(f"Could not copy library tags from {DYNAMO['source']}: {err}")
+    LOGGER.info(f"Cloned {COUNT['cloned']:,} items and {len(tags)} library tags")
+
+
+def read_snapshot():
+    ''' Read the library's items from the snapshot file. The snapshot is only used if
+        it was written (after writing the items) to this run's table for the same
+        libraries.
+        Keyword arguments:
+          None
+        Returns:
+          Dictionary of items keyed by primary key (None if the snapshot can't be used)
+    '''
+    table = DATABASE["DYN"].name
+    current = {}
+    try:
+        with gzip.open(ARG.SNAPSHOT, 'rt', encoding='utf-8') as instream:
+            header = json.loads(instream.readline()).get("header", {})
+            # --output files aren't snapshots, since they may never have been loaded
+            written = header.get("table")
+            if not written:
+                LOGGER.warning(f"Ignoring {ARG.SNAPSHOT}, which has no table name")
+                return None
+            if written != table:
+                LOGGER.warning(f"Ignoring {ARG.SNAPSHOT}, which is for table {written}")
+                return None
+            if header.get("libraries") != sorted(DDB_NB):
+                LOGGER.warning(f"Ignoring {ARG.SNAPSHOT}, which is for " \
+                               + f"{', '.join(header.get('libraries') or ['unknown libraries'])}")
+                return None
+            for line in instream:
+                item = json.loads(line)
+                current[item_key(item)] = item
+    except Exception as err:
+        terminate_program(err)
+    LOGGER.info(f"Read {len(current):,} items from snapshot {ARG.SNAPSHOT}")
+    return current
+
+
+def write_items(path, header=None):
+    ''' Write the items for this run to a gzipped NDJSON file (a snapshot or --output)
+        Keyword arguments:
+          path: file path
+          header: optional header record for the first line
+        Returns:
+          None
+    '''
+    try:
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8') as outstream:
+            if header:
+                outstream.write(json.dumps({"header": header}) + "\n")
+            for item in ITEMS:
+                outstream.write(json.dumps(item) + "\n")
+        os.replace(path + '.tmp', path)
+    except Exception as err:
+        terminate_program(err)
+    LOGGER.info(f"Wrote {len(ITEMS):,} items to {path}")
+
+
+def read_header():
+    ''' Read the header of a --load file. The NeuronBridge and DynamoDB versions are
+        taken from it, and must match them if they were specified.
+        Keyword arguments:
+          None
+        Returns:
+          Header dictionary
+    '''
+    try:
+        with gzip.open(ARG.LOAD, 'rt', encoding='utf-8') as instream:
+            header = json.loads(instream.readline()).get("header")
+    except Exception as err:
+        terminate_program(err)
+    if not header:
+        terminate_program(f"{ARG.LOAD} has no header - was it written with --output?")
+    for arg, key in (("VERSION", "version"), ("DDBVERSION", "ddbversion")):
+        if getattr(ARG, arg) and getattr(ARG, arg) != header[key]:
+            terminate_program(f"{ARG.LOAD} was written for {key} {header[key]}, " \
+                              + f"not {getattr(ARG, arg)}")
+        setattr(ARG, arg, header[key])
+    LOGGER.info(f"{ARG.LOAD} has {header['items']:,} items for {', '.join(header['components'])}")
+    return header
+
+
+def read_offset(table):
+    ''' Return the number of items already loaded into a table from the --load file
+        Keyword arguments:
+          table: DynamoDB table name
+        Returns:
+          Number of items
+    '''
+    sidecar = ARG.LOAD + '.offset'
+    if not os.path.exists(sidecar):
+        return 0
+    try:
+        with open(sidecar, 'r', encoding='ascii') as instream:
+            offset = json.load(instream)
+        written, loaded = offset["table"], int(offset["offset"])
+    except Exception as err:
+        terminate_program(f"Could not read {sidecar} (remove it to reload every item): {err}")
+    if written != table:
+        LOGGER.warning(f"Ignoring {sidecar}, which is for table {written}")
+        return 0
+    LOGGER.warning(f"Resuming load after {loaded:,} items")
+    return loaded
+
+
+def write_offset(table, offset):
+    ''' Record the number of items loaded into a table from the --load file
         Keyword arguments:
+          table: DynamoDB table name
+          offset: number of items
+        Returns:
           None
+    '''
+    sidecar = ARG.LOAD + '.offset'
+    with open(sidecar + '.tmp', 'w', encoding='ascii') as outstream:
+        json.dump({"table": table, "offset": offset}, outstream)
+    os.replace(sidecar + '.tmp', sidecar)
+
+
+def still_published(item, publishedurl):
+    ''' Determine if an item that wasn't built by this run may still belong to a
+        library (in this version) other than the one being published
+        Keyword arguments:
+          item: DynamoDB item
+          publishedurl: published names in publishedURL
+        Returns:
+          True if the item should be kept
+    '''
+    if item["keyType"] in ("bodyID", "publishingName"):
+        return item["name"] in publishedurl
+    if item["keyType"] == "neuronInstance":
+        return "neuronInstance" not in NEURON_BODIES \
+               or item["name"] in NEURON_BODIES["neuronInstance"]
+    return (not NEURON_MAP) or item["name"] in NEURON_MAP
+
+
+def same_item(old, new):
+    ''' Determine if a current item is the same as one built by this run. The order of
+        the body IDs from MongoDB isn't stable, so it's ignored.
+        Keyword arguments:
+          old: current item (or None)
+          new: item built by this run
+        Returns:
+          True if the items are the same
+    '''
+    if old is None or "bodyIDs" not in new:
+        return old == new
+    return {**old, "bodyIDs": sorted(old.get("bodyIDs", []))} \
+           == {**new, "bodyIDs": sorted(new["bodyIDs"])}
+
+
+def compute_delta(publishedurl):
+    ''' Compare the items built by this run with the current items (from the clone, the
+        snapshot, or a scan of the table). Items are written if they are new or changed,
+        and current items that weren't built are deleted if they're no longer published.
+        Keyword arguments:
+          publishedurl: published names in publishedURL
+        Returns:
+          List of items to write and list of items to delete
+    '''
+    current = None
+    if ARG.CLONE_FROM:
+        # Without --write, the table wasn't cloned, so compare with the source table
+        current = DYNAMO.pop('cloned', None)
+        if current is None:
+            current = scan_table(DYNAMO['source'])
+    elif ARG.SNAPSHOT and os.path.exists(ARG.SNAPSHOT):
+        current = read_snapshot()
+    if current is None:
+        current = scan_table(DATABASE["DYN"].name)
+    puts = []
+    for item in ITEMS:
+        key = item_key(item)
+        if same_item(current.pop(key, None), item):
+            COUNT["unchanged"] += 1
+        else:
+            puts.append(item)
+    deletes = []
+    for item in current.values():
+        if still_published(item, publishedurl):
+            COUNT["kept"] += 1
+        else:
+            deletes.append(item)
+    LOGGER.info(f"Delta: {len(puts):,} items to write, {len(deletes):,} to delete, " \
+                + f"{COUNT['unchanged']:,} unchanged")
+    return puts, deletes
+
+
+def write_dynamodb(puts, deletes=None):
+    ''' Write and delete items in DynamoDB in batches
+        Keyword arguments:
+          puts: items to write
+          deletes: items to delete
         Returns:
           None
     '''
-    LOGGER.info(f"Batch writing {len(ITEMS):,} items to DynamoDB")
-    with DATABASE["DYN"].batch_writer() as writer:
-        for item in tqdm(ITEMS, desc="DynamoDB"):
-            if ARG.THROTTLE and (not COUNT["insertions"] % ARG.THROTTLE):
-                time.sleep(2)
-            writer.put_item(Item=item)
-            COUNT["insertions"] += 1
+    deletes = deletes or []
+    LOGGER.info(f"Batch writing {len(puts):,} items to DynamoDB")
+    if deletes:
+        LOGGER.info(f"Batch deleting {len(deletes):,} items from DynamoDB")
+    write_requests(chain((put_request(item) for item in puts),
+                         (delete_request(item) for item in deletes)),
+                   len(puts) + len(deletes))
 
 
 def display_counts():
@@ -377,7 +1005,15 @@ def display_counts():
         print(f"No consensus:              {COUNT['consensus']:,}")
     if COUNT['notreleased']:
         print(f"Not released:              {COUNT['notreleased']:,}")
+    if COUNT['cloned']:
+        print(f"Items cloned:              {COUNT['cloned']:,}")
     print(f"Items written to DynamoDB: {COUNT['insertions']:,}")
+    if ARG.DELTA:
+        print(f"Items deleted:             {COUNT['deletions']:,}")
+        print(f"Items unchanged:           {COUNT['unchanged']:,}")
+        print(f"Items kept (other libs):   {COUNT['kept']:,}")
+    if COUNT['throttled']:
+        print(f"Throttled batch writes:    {COUNT['throttled']:,}")
     print(f"  bodyID:                  {COUNT['bodyID']:,}")
     print(f"  neuronInstance:          {COUNT['neuronInstance']:,}")
     print(f"  neuronType:              {COUNT['neuronType']:,}")
@@ -426,6 +1062,75 @@ def update_neuron_map():
     LOGGER.info(f"Neuron types mapped: {len(NEURON_MAP):,}")
 
 
+def tag_libraries(libraries):
+    ''' Tag the table with the libraries (and version) written to it
+        Keyword arguments:
+          libraries: iterable of library names
+        Returns:
+          None
+    '''
+    dts = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+    for lib in libraries:
+        key = " - ".join([lib, ARG.VERSION])
+        resp = DYNAMO['client'].tag_resource(ResourceArn=DYNAMO['arn'],
+                                             Tags=[{'Key': key,
+                                                    'Value': dts},])
+        if 'HTTPStatusCode' not in resp['ResponseMetadata'] or \
+           resp['ResponseMetadata']['HTTPStatusCode'] != 200:
+            LOGGER.warning("Could not write tag for %s", key)
+
+
+def update_manifest():
+    ''' Update the ddb_published_versioned manifest with the libraries in DDB_NB
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    coll = DATABASE["NB"]["ddb_published_versioned"]
+    LOGGER.info("Updating ddb_published_versioned for version %s", ARG.DDBVERSION)
+    payload = coll.find_one({"dynamodb_version": ARG.DDBVERSION})
+    if not payload and ARG.CLONE_FROM:
+        payload = coll.find_one({"dynamodb_version": ARG.CLONE_FROM}, {"_id": 0})
+        if payload:
+            payload["dynamodb_version"] = ARG.DDBVERSION
+    if not payload:
+        payload = {"dynamodb_version": ARG.DDBVERSION,
+                   "components": {}}
+    for lib, val in DDB_NB.items():
+        payload['components'][lib] = val
+    coll.update_one({"dynamodb_version": ARG.DDBVERSION}, {"$set": payload}, upsert=True)
+
+
+def load_items(header):
+    ''' Load the items from a --load file into the table. The number of items loaded is
+        kept in a sidecar file (FILE.offset), so an interrupted load can be resumed.
+        Keyword arguments:
+          header: header from the --load file
+        Returns:
+          None
+    '''
+    table = DATABASE["DYN"].name
+    offset = read_offset(table)
+    remaining = header["items"] - offset
+    if not ARG.WRITE:
+        LOGGER.warning(f"Would load {remaining:,} items into {table}")
+        return
+    LOGGER.info(f"Loading {remaining:,} items into {table}")
+    try:
+        with gzip.open(ARG.LOAD, 'rt', encoding='utf-8') as instream:
+            items = (json.loads(line) for line in islice(instream, 1 + offset, None))
+            write_requests((put_request(item) for item in items), remaining, "Load",
+                           lambda written: write_offset(table, offset + written))
+    except Exception as err:
+        terminate_program(err)
+    os.remove(ARG.LOAD + '.offset')
+    tag_libraries(header["components"])
+    DDB_NB.update(header["components"])
+    update_manifest()
+    print(f"Items loaded into {table}: {COUNT['insertions']:,}")
+
+
 def process_results(count, results, publishedurl):
     ''' Process results from neuronMetadata table
         Keyword arguments:
@@ -501,22 +1206,54 @@ def process_results(count, results, publishedurl):
         with open('neuron_body_matches.txt', 'w', encoding='ascii') as outstream:
             for row in NBODY:
                 outstream.write(f"{row}\n")
+    if ARG.OUTPUT:
+        write_items(ARG.OUTPUT, {"version": ARG.VERSION, "ddbversion": ARG.DDBVERSION,
+                                 "items": len(ITEMS), "components": DDB_NB})
+        COUNT["insertions"] = len(ITEMS)
+        display_counts()
+        return
+    puts, deletes = compute_delta(publishedurl) if ARG.DELTA else (ITEMS, [])
     if ARG.WRITE:
-        write_dynamodb()
-        dts = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-        for lib in library:
-            key = " - ".join([lib, ARG.VERSION])
-            resp = DYNAMO['client'].tag_resource(ResourceArn=DYNAMO['arn'],
-                                                 Tags=[{'Key': key,
-                                                        'Value': dts},])
-            if 'HTTPStatusCode' not in resp['ResponseMetadata'] or \
-               resp['ResponseMetadata']['HTTPStatusCode'] != 200:
-                LOGGER.warning("Could not write tag for %s", key)
+        write_dynamodb(puts, deletes)
+        if ARG.SNAPSHOT:
+            write_items(ARG.SNAPSHOT, {"table": DATABASE["DYN"].name,
+                                       "libraries": sorted(DDB_NB)})
+        tag_libraries(library)
     else:
-        COUNT["insertions"] = len(ITEMS)
+        COUNT["insertions"] = len(puts)
+        COUNT["deletions"] = len(deletes)
     display_counts()
 
 
+def process_libraries(payload, publishedurl):
+    ''' Build (and write) the items for the chosen libraries
+        Keyword arguments:
+          payload: neuronMetadata query for the chosen libraries
+          publishedurl: published names in publishedURL
+        Returns:
+          None
+    '''
+    coll = DATABASE["NB"]["neuronMetadata"]
+    project = {"libraryName": 1, "publishedName": 1, "slideCode": 1,
+               "processedTags": 1, "neuronInstance": 1, "neuronType": 1, "neuronTerms": 1}
+    count = coll.count_documents(payload)
+    if not count:
+        LOGGER.error("There are no processed tags for version %s", ARG.VERSION)
+        results = {}
+    else:
+        LOGGER.info("Selecting images from neuronMetadata")
+        results = coll.find(payload, project)
+    LOGGER.info("Finding PPP matches in pppMatches")
+    coll = DATABASE["NB"]["pppMatches"]
+    pppresults = coll.distinct("sourceEmName")
+    for row in pppresults:
+        KNOWN_PPP[row.split("-")[0]] = True
+    if any('flylight' not in lib for lib in payload["libraryName"]["$in"]):
+        update_neuron_map()
+    LOGGER.info(f"Processing neuronMetadata ({count:,} images)")
+    process_results(count, results, publishedurl)
+
+
 def update_dynamo():
     ''' Main routine to update DynamoDB from MongoDB neuronMetadata
         Keyword arguments:
@@ -550,48 +1287,39 @@ def update_dynamo():
     if not lkeys:
         terminate_program(f"There are no processed tags for version {ARG.VERSION}")
     lchoices.sort()
-    # This used to be a Checkbox, but it's now a List. Running more that
-    # one library will likely cause DynamoDB to hit write limits.
-    questions = [inquirer.List("to_include",
-                               message=f"Choose {ARG.VERSION} library",
-                               choices=lchoices,
-                               default=lkeys,
-                               carousel=True)]
-    answers = inquirer.prompt(questions, theme=BlueComposure())
-    if answers and answers["to_include"]:
-        payload["libraryName"] = {"$in": [answers["to_include"]]}
+    if ARG.CLONE_FROM:
+        # Only the libraries that changed since the cloned version need to be applied
+        questions = [inquirer.Checkbox("to_include",
+                                       message=f"Choose {ARG.VERSION} libraries that " \
+                                               + f"changed since {ARG.CLONE_FROM}",
+                                       choices=lchoices,
+                                       carousel=True)]
     else:
+        # This used to be a Checkbox, but it's now a List. Running more that
+        # one library will likely cause DynamoDB to hit write limits.
+        questions = [inquirer.List("to_include",
+                                   message=f"Choose {ARG.VERSION} library",
+                                   choices=lchoices,
+                                   default=lkeys,
+                                   carousel=True)]
+    answers = inquirer.prompt(questions, theme=BlueComposure())
+    if answers is None:
         terminate_program("No libraries were chosen")
-    project = {"libraryName": 1, "publishedName": 1, "slideCode": 1,
-               "processedTags": 1, "neuronInstance": 1, "neuronType": 1, "neuronTerms": 1}
-    count = coll.count_documents(payload)
-    if not count:
-        LOGGER.error("There are no processed tags for version %s", ARG.VERSION)
-        results = {}
-    else:
-        LOGGER.info("Selecting images from neuronMetadata")
-        results = coll.find(payload, project)
-    LOGGER.info("Finding PPP matches in pppMatches")
-    coll = DATABASE["NB"]["pppMatches"]
-    pppresults = coll.distinct("sourceEmName")
-    for row in pppresults:
-        KNOWN_PPP[row.split("-")[0]] = True
-    if 'flylight' not in answers["to_include"]:
-        update_neuron_map()
-    LOGGER.info(f"Processing neuronMetadata ({count:,} images)")
-    process_results(count, results, publishedurl)
+    chosen = answers["to_include"]
+    if not isinstance(chosen, list):
+        chosen = [chosen] if chosen else []
+    if ARG.CLONE_FROM:
+        clone_table()
+    elif not chosen:
+        terminate_program("No libraries were chosen")
+    if chosen:
+        payload["libraryName"] = {"$in": chosen}
+        process_libraries(payload, publishedurl)
+    elif ARG.WRITE:
+        display_counts()
     # Done with the changes to DynamoDB! Update the manifest in MongoDB.
-    if not ARG.WRITE:
-        return
-    coll = DATABASE["NB"]["ddb_published_versioned"]
-    LOGGER.info("Updating ddb_published_versioned for version %s", ARG.DDBVERSION)
-    payload = coll.find_one({"dynamodb_version": ARG.DDBVERSION})
-    if not payload:
-        payload = {"dynamodb_version": ARG.DDBVERSION,
-                   "components": {}}
-    for lib, val in DDB_NB.items():
-        payload['components'][lib] = val
-    results = coll.update_one({"dynamodb_version": ARG.DDBVERSION}, {"$set": payload}, upsert=True)
+    if ARG.WRITE:
+        update_manifest()
 
 
 if __name__ == '__main__':
@@ -607,14 +1335,56 @@ if __name__ == '__main__':
                         help='DynamoDB manifold')
     PARSER.add_argument('--write', action='store_true', dest='WRITE',
                         default=False, help='Write to DynamoDB')
+    PARSER.add_argument('--max-wcu', type=int, dest='MAX_WCU',
+                        default=0, help='Maximum DynamoDB write rate (write capacity ' \
+                                        + 'units/sec, 0 for no limit)')
     PARSER.add_argument('--throttle', type=int, dest='THROTTLE',
-                        default=0, help='DynamoDB batch write throttle (# items)')
+                        default=0, help='DynamoDB batch write throttle (# items, deprecated: ' \
+                                        + 'use --max-wcu)')
+    PARSER.add_argument('--delta', action='store_true', dest='DELTA',
+                        default=False, help='Only write new and changed items, and delete ' \
+                                            + 'items that are no longer published')
+    PARSER.add_argument('--snapshot', dest='SNAPSHOT', action='store',
+                        default='', help='Snapshot (gzipped NDJSON) of the library\'s items, ' \
+                                         + 'read by --delta instead of scanning the table ' \
+                                         + 'and rewritten after writing')
+    PARSER.add_argument('--clone-from', dest='CLONE_FROM', default='',
+                        help='DynamoDB NeuronBridge version to copy into the new version ' \
+                             + 'before applying the libraries that changed (implies --delta)')
+    PARSER.add_argument('--output', dest='OUTPUT', action='store',
+                        default='', help='Write the items to this gzipped NDJSON file ' \
+                                         + 'instead of DynamoDB')
+    PARSER.add_argument('--load', dest='LOAD', action='store',
+                        default='', help='Load the items from an --output file (resumable)')
+    PARSER.add_argument('--writers', type=int, dest='WRITERS',
+                        default=8, help='Number of concurrent DynamoDB batch writers')
     PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
     PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
                         default=False, help='Flag, Very chatty')
     ARG = PARSER.parse_args()
     LOGGER = JRC.setup_logging(ARG)
+    if ARG.WRITERS < 1 or ARG.MAX_WCU < 0 or ARG.THROTTLE < 0:
+        terminate_program("--writers must be at least 1, and --max-wcu and --throttle " \
+                          + "can't be negative")
+    if ARG.THROTTLE:
+        if ARG.MAX_WCU:
+            terminate_program("--throttle can't be used with --max-wcu")
+        # --throttle used to sleep for 2 seconds after every THROTTLE items
+        ARG.MAX_WCU = max(1, ARG.THROTTLE // 2)
+        LOGGER.warning(f"--throttle is deprecated; using --max-wcu {ARG.MAX_WCU}")
+    if ARG.OUTPUT and (ARG.WRITE or ARG.DELTA or ARG.CLONE_FROM or ARG.LOAD):
+        terminate_program("--output can't be used with --write, --delta, --clone-from, " \
+                          + "or --load")
+    if ARG.LOAD and (ARG.DELTA or ARG.CLONE_FROM):
+        terminate_program("--load can't be used with --delta or --clone-from")
+    if ARG.CLONE_FROM:
+        ARG.DELTA = True
+    if ARG.LOAD:
+        HEADER = read_header()
     initialize_program()
-    update_dynamo()
+    if ARG.LOAD:
+        load_items(HEADER)
+    else:
+        update_dynamo()
     terminate_program()
@@ -4,25 +4,42 @@
 __version__ = '2.5.1'
 
 import argparse
+from bisect import bisect_left
 import collections
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, \
+                               ThreadPoolExecutor, wait
 from copy import deepcopy
 from datetime import datetime
+import dbm
+import glob
+import gzip
+import hashlib
+import io
+from itertools import chain
 import json
+import multiprocessing
 from operator import attrgetter
 import os
+import queue
 import re
+import shelve
 import socket
 import sys
-from time import strftime
+import threading
+from time import perf_counter, strftime
 from types import SimpleNamespace
 import boto3
-from botocore.exceptions import ClientError
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import inquirer
 import requests
 from simple_term_menu import TerminalMenu
 from tqdm import tqdm
 import MySQLdb
 from PIL import Image
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import jrc_common.jrc_common as JRC
 import neuronbridge_common.neuronbridge_common as NB
 
@@ -38,27 +55,62 @@ MONGODB = 'neuronbridge-mongo'
 DBM = {}
 CONN = {}
 CURSOR = {}
+READER = {'cursor': None, 'stop': None, 'thread': None} # neuronMetadata cursor and reader
+UPSERTS = [] # Pending publishedURL upserts
+MONGO_WRITE = {'executor': None, 'pending': {}} # publishedURL bulk writes in flight
 # AWS
 S3_CLIENT = S3_RESOURCE = ''
 S3_SECONDS = 60 * 60 * 12
+# Uploads in flight (and the objects they're for), and the sample being processed. A
+# sample's output is held until all of its uploads have completed.
+UPLOAD = {'executor': None, 'pending': {}, 'objects': {}, 'sample': None,
+          'lock': threading.Lock()}
+WORKER = {} # Throughput by upload worker
+# PNG conversion (done and source only hold the sample being processed)
+CONVERT = {'executor': None, 'pending': {}, 'done': set(), 'source': {}, 'thumbnails': {}}
+THUMBNAIL_WIDTH = 300 # Default thumbnail width (pixels) and JPEG quality
+THUMBNAIL_QUALITY = 85
+# Image validation (computeFiles checked by --validate)
+VALIDATE_FILES = ['SourceColorDepthImage', 'InputColorDepthImage', 'GradientImage', 'ZGapImage']
+BUFFERED = {} # Converted images held in memory (keyed by the PNG filepath they replace)
+# Output streams
+OUTPUT = {'json': None, 'names': None, 'keys': None, 'packing': None}
+SHARD_OUTPUT = {'errors': '_errors_*.txt', 's3cp': '_s3cp_*.txt', 'names': '_*.names',
+                'json': '_*.ndjson*', 'keys': '_keys_*.txt*', 'counts': '_counts_*.json'}
+# Digest cache of unchanged uploads, and recently computed source checksums
+DIGEST = {'db': None, 'md5': {}}
+# Upload plan
+PLAN = {'stream': None, 'objects': 0, 'bytes': 0, 'documents': 0}
+PLAN_COLUMNS = ['source', 'bucket', 'key', 'size', 'mimetype', 'convert', 'document']
+# Checkpoint journal
+JOURNAL = {'stream': None, 'committed': set(), 'samples': [], 'keys': [], 'names': [],
+           'json': [], 's3cp': []}
 # Counters
 COUNT = collections.defaultdict(lambda: 0, {})
+# Stage timing (histogram bucket upper bounds are in seconds)
+STAGE = {}
+STAGE_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60]
+METRICS = {'lock': threading.Lock(), 'start': perf_counter(), 'written': perf_counter()}
 # Searchable neurons
-SUBDIVISION = {'prefix': 1, 'counter': 0, 'limit': 100}
+SUBDIVISION = {'prefix': 1, 'counter': 0, 'limit': 100, 'stride': 1, 'bytes': 0}
+PACKING = {} # Subdivisions from the packing file (keyed by object name)
 # File naming
 REC = {'line': '', 'slide_code': '', 'gender': '', 'objective': '', 'area': ''}
 # General use
 CONF = {}
 DRIVER = {} # Driver by line
 FALLBACK = {}
-KEY_LIST = []
 MANIFEST = {}
+MAPPING = {} # Mapping tables cached for batches (by publishing database)
 NON_PUBLIC = {}
 NO_RELEASE = {}
 PNAME = {}
+PUBLISHED_ID = set()
 RELEASE = {}
 RELPUB = {}
-UPLOADED_NAME = {}
+# Uploaded object names -> source filepaths. Both are stored with interned directory
+# prefixes, and the map can be moved to disk with --name-store.
+UPLOADED = {'names': {}, 'index': {}, 'prefixes': []}
 VARIANT_UPLOADS = {}
 
 
@@ -69,12 +121,9 @@ def terminate_program(msg=None):
         Returns:
           None
     '''
+    close_reader()
     if S3CP:
-        ERR.close()
-        S3CP.close()
-        for fpath in [ERR_FILE, S3CP_FILE, JSONO_FILE, NAMES_FILE]:
-            if os.path.exists(fpath) and not os.path.getsize(fpath):
-                os.remove(fpath)
+        close_run_files()
     if msg:
         if not isinstance(msg, str):
             msg = f"An exception of type {type(msg).__name__} occurred. Arguments:\n{msg.args}"
@@ -82,6 +131,229 @@ def terminate_program(msg=None):
     sys.exit(-1 if msg else 0)
 
 
+def close_run_files():
+    ''' Close the error, order, and output files, and remove the ones that are empty
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    global ERR, S3CP # pylint: disable=W0603
+    ERR.close()
+    S3CP.close()
+    close_output_files()
+    for fpath in [ERR_FILE, S3CP_FILE, output_path(JSONO_FILE), NAMES_FILE]:
+        if os.path.exists(fpath) and empty_output(fpath):
+            os.remove(fpath)
+    ERR = S3CP = ''
+
+
+def empty_output(fpath):
+    ''' Determine if an output file is empty. A compressed file with no content
+        still has a gzip header.
+        Keyword arguments:
+          fpath: file path
+        Returns:
+          True if the file has no content
+    '''
+    if not os.path.getsize(fpath):
+        return True
+    if not fpath.endswith('.gz'):
+        return False
+    with gzip.open(fpath, 'rb') as instream:
+        return not instream.read(1)
+
+
+def record_stage(stage, seconds, nbytes=0):
+    ''' Record the time taken (and bytes handled) by one operation in a stage. This
+        is called from the upload worker threads as well as the main thread.
+        Keyword arguments:
+          stage: stage name
+          seconds: elapsed wall-clock time
+          nbytes: number of bytes handled
+        Returns:
+          None
+    '''
+    with METRICS['lock']:
+        if stage not in STAGE:
+            STAGE[stage] = {'count': 0, 'seconds': 0.0, 'bytes': 0,
+                            'buckets': [0] * (len(STAGE_BUCKETS) + 1)}
+        STAGE[stage]['count'] += 1
+        STAGE[stage]['seconds'] += seconds
+        STAGE[stage]['bytes'] += nbytes
+        STAGE[stage]['buckets'][bisect_left(STAGE_BUCKETS, seconds)] += 1
+
+
+def timed(data, stage):
+    ''' Yield the items from an iterable, recording the time spent waiting for each
+        Keyword arguments:
+          data: iterable (e.g. a Mongo cursor)
+          stage: stage name
+        Returns:
+          Generator of items
+    '''
+    data = iter(data)
+    while True:
+        start = perf_counter()
+        try:
+            item = next(data)
+        except StopIteration:
+            return
+        record_stage(stage, perf_counter() - start)
+        yield item
+
+
+def prefetch(data, stage):
+    ''' Yield the items from an iterable that is read ahead by a reader thread into a
+        queue of up to --prefetch items, so that the main loop doesn't wait on each
+        cursor batch. The reader blocks when the queue is full. The time spent waiting
+        for each item is recorded for the stage.
+        Keyword arguments:
+          data: iterable (e.g. a Mongo cursor)
+          stage: stage name
+        Returns:
+          Generator of items
+    '''
+    if not ARG.PREFETCH:
+        yield from timed(data, stage)
+        return
+    buffer = queue.Queue(maxsize=ARG.PREFETCH)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def reader():
+        try:
+            for item in data:
+                if not put(item):
+                    return
+        except Exception as err:
+            put(err)
+            return
+        put(None)
+
+    thread = threading.Thread(target=reader, name='mongo_reader', daemon=True)
+    READER['stop'], READER['thread'] = stop, thread
+    thread.start()
+    try:
+        while True:
+            start = perf_counter()
+            item = buffer.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                terminate_program(item)
+            record_stage(stage, perf_counter() - start)
+            yield item
+    finally:
+        # Stop the reader if the main loop ends early (e.g. --samples)
+        stop.set()
+        thread.join()
+
+
+def close_reader():
+    ''' Stop the prefetch reader and close the neuronMetadata cursor. The cursor is
+        opened with no_cursor_timeout, so it's closed on every exit path.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if READER['stop']:
+        READER['stop'].set()
+        READER['thread'].join()
+    if READER['cursor']:
+        READER['cursor'].close()
+    READER.update({'cursor': None, 'stop': None, 'thread': None})
+
+
+def metrics_json():
+    ''' Return the stage metrics as a dictionary
+        Keyword arguments:
+          None
+        Returns:
+          Dictionary of metrics
+    '''
+    with METRICS['lock']:
+        stages = deepcopy(STAGE)
+    for stat in stages.values():
+        stat['bytes_per_second'] = stat['bytes'] / stat['seconds'] if stat['seconds'] else 0
+        stat['buckets'] = dict(zip([str(bnd) for bnd in STAGE_BUCKETS] + ['+Inf'],
+                                   stat['buckets']))
+    return {"library": ARG.LIBRARY, "alignment": ARG.ALIGNMENT, "host": socket.gethostname(),
+            "elapsed": perf_counter() - METRICS['start'], "stages": stages,
+            "counts": dict(COUNT)}
+
+
+def metrics_prometheus(data):
+    ''' Return the stage metrics in the Prometheus text exposition format
+        Keyword arguments:
+          data: metrics from metrics_json()
+        Returns:
+          Metrics text
+    '''
+    base = f'library="{data["library"]}",alignment="{data["alignment"]}"'
+    lines = ["# HELP upload_cdms_stage_seconds Wall-clock time of each stage operation",
+             "# TYPE upload_cdms_stage_seconds histogram"]
+    for stage, stat in sorted(data['stages'].items()):
+        labels = f'{base},stage="{stage}"'
+        total = 0
+        for bound, count in stat['buckets'].items():
+            total += count
+            lines.append(f'upload_cdms_stage_seconds_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f"upload_cdms_stage_seconds_sum{{{labels}}} {stat['seconds']:f}")
+        lines.append(f"upload_cdms_stage_seconds_count{{{labels}}} {stat['count']}")
+    lines.extend(["# HELP upload_cdms_stage_bytes_total Bytes handled by each stage",
+                  "# TYPE upload_cdms_stage_bytes_total counter"])
+    for stage, stat in sorted(data['stages'].items()):
+        lines.append(f'upload_cdms_stage_bytes_total{{{base},stage="{stage}"}} {stat["bytes"]}')
+    lines.extend(["# HELP upload_cdms_stage_bytes_per_second Stage throughput",
+                  "# TYPE upload_cdms_stage_bytes_per_second gauge"])
+    for stage, stat in sorted(data['stages'].items()):
+        lines.append(f'upload_cdms_stage_bytes_per_second{{{base},stage="{stage}"}} ' \
+                     + f"{stat['bytes_per_second']:f}")
+    lines.extend(["# HELP upload_cdms_events_total Program counters",
+                  "# TYPE upload_cdms_events_total counter"])
+    for key, val in sorted(data['counts'].items()):
+        lines.append(f'upload_cdms_events_total{{{base},event="{key}"}} {val}')
+    lines.extend(["# HELP upload_cdms_elapsed_seconds Time since the run started",
+                  "# TYPE upload_cdms_elapsed_seconds gauge",
+                  f"upload_cdms_elapsed_seconds{{{base}}} {data['elapsed']:f}"])
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics(force=False):
+    ''' Write the stage metrics to <--metrics>.json and <--metrics>.prom (for the node
+        exporter textfile collector). Files are replaced atomically, and are written
+        every --metrics-interval seconds.
+        Keyword arguments:
+          force: write the metrics regardless of when they were last written
+        Returns:
+          None
+    '''
+    if not ARG.METRICS:
+        return
+    if not force and perf_counter() - METRICS['written'] < ARG.METRICS_INTERVAL:
+        return
+    METRICS['written'] = perf_counter()
+    data = metrics_json()
+    for suffix, text in (('.json', json.dumps(data, indent=2) + "\n"),
+                         ('.prom', metrics_prometheus(data))):
+        try:
+            with open(ARG.METRICS + suffix + '.tmp', 'w', encoding='ascii') as outstream:
+                outstream.write(text)
+            os.replace(ARG.METRICS + suffix + '.tmp', ARG.METRICS + suffix)
+        except OSError as err:
+            LOGGER.warning(f"Could not write metrics to {ARG.METRICS + suffix}: {err}")
+
+
 def call_responder(server, endpoint, payload='', authenticate=False):
     ''' Call a responder
         Keyword arguments:
@@ -146,20 +418,23 @@ def initialize_s3():
     """
     global S3_CLIENT, S3_RESOURCE # pylint: disable=W0603
     LOGGER.info("Opening S3 client and resource")
+    # The client is shared by the upload workers, so size its connection pool to match
+    config = Config(max_pool_connections=max(10, ARG.WORKERS))
+    endpoint = ARG.ENDPOINT if ARG.ENDPOINT else None
     if "dev" in ARG.MANIFOLD:
-        S3_CLIENT = boto3.client('s3')
-        S3_RESOURCE = boto3.resource('s3')
+        S3_CLIENT = boto3.client('s3', config=config, endpoint_url=endpoint)
+        S3_RESOURCE = boto3.resource('s3', endpoint_url=endpoint)
     else:
         sts_client = boto3.client('sts')
         aro = sts_client.assume_role(RoleArn=AWS.role_arn,
                                      RoleSessionName="AssumeRoleSession1",
                                      DurationSeconds=S3_SECONDS)
         credentials = aro['Credentials']
-        S3_CLIENT = boto3.client('s3',
+        S3_CLIENT = boto3.client('s3', config=config, endpoint_url=endpoint,
                                  aws_access_key_id=credentials['AccessKeyId'],
                                  aws_secret_access_key=credentials['SecretAccessKey'],
                                  aws_session_token=credentials['SessionToken'])
-        S3_RESOURCE = boto3.resource('s3',
+        S3_RESOURCE = boto3.resource('s3', endpoint_url=endpoint,
                                      aws_access_key_id=credentials['AccessKeyId'],
                                      aws_secret_access_key=credentials['SecretAccessKey'],
                                      aws_session_token=credentials['SessionToken'])
@@ -278,33 +553,84 @@ def set_searchable_subdivision(smp):
             num = obj["Prefix"].split("/")[-2]
             if num.isdigit() and int(num) > maxnum:
                 maxnum = int(num)
-    SUBDIVISION['prefix'] = maxnum + 1
+    prefix = maxnum + 1
+    if 'SHARD' in CONF:
+        # Each shard only uses subdivisions congruent to its index, so no two shards
+        # will ever write to the same subdivision
+        shard, total = CONF['SHARD']
+        prefix += (shard - (prefix - 1)) % total
+        SUBDIVISION['stride'] = total
+    SUBDIVISION['prefix'] = prefix
     LOGGER.warning("Will upload searchable neurons starting with subdivision %s",
                    SUBDIVISION['prefix'])
 
 
-def select_uploads():
-    """ Query the user for which image types to upload
+def select_uploads(variants=None):
+    """ Select the image types to upload. They're taken from the batch file or
+        --variants if specified; otherwise the user is asked (or the defaults are
+        used in batch mode).
         Keyword arguments:
-            None
+            variants: image types from the batch file (None if not specified)
         Returns:
             None
     """
     global WILL_LOAD, REQUIRED_PRODUCTS # pylint: disable=W0603
-    choices = CLOAD.variants
+    choices = list(CLOAD.variants)
     defaults = ["searchable_neurons"]
     if not ARG.LIBRARY.startswith('flylight'):
         choices.append("skeletons")
         defaults.append("skeletons")
-    quest = [inquirer.Checkbox('checklist',
-                               message='Select image types to upload',
-                               choices=choices, default=defaults)]
-    WILL_LOAD = inquirer.prompt(quest)['checklist']
+    if variants is None and ARG.VARIANTS:
+        variants = ARG.VARIANTS.split(',')
+    if variants is not None:
+        unknown = [var for var in variants if var not in choices]
+        if unknown:
+            terminate_program(f"Unknown image types for {ARG.LIBRARY}: {', '.join(unknown)}")
+        WILL_LOAD = variants
+    elif ARG.BATCH:
+        WILL_LOAD = defaults
+    else:
+        quest = [inquirer.Checkbox('checklist',
+                                   message='Select image types to upload',
+                                   choices=choices, default=defaults)]
+        WILL_LOAD = inquirer.prompt(quest)['checklist']
+    # This is called for each library in a batch
+    REQUIRED_PRODUCTS = ['cdm', 'cdm_thumbnail']
     for var in CLOAD.variants:
         if var in WILL_LOAD and var != "skeletons":
             REQUIRED_PRODUCTS.append(var)
 
 
+def read_batch():
+    ''' Read the batch file. Each line has a library, an alignment space, an optional
+        NeuronBridge version tag (--tag is used if it's omitted or "-"), and an optional
+        comma-separated list of image types to upload (--variants or the defaults are
+        used if it's omitted).
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    CONF['BATCH'] = []
+    with open(ARG.BATCH, 'r', encoding='ascii') as instream:
+        for line in instream:
+            field = line.split('#')[0].split()
+            if not field:
+                continue
+            if len(field) not in (2, 3, 4):
+                terminate_program(f"Invalid batch line: {line.strip()}")
+            if field[0] not in LIBRARY:
+                terminate_program(f"Unknown library {field[0]}")
+            tag = field[2] if len(field) >= 3 and field[2] != '-' else ARG.TAG
+            if not tag:
+                terminate_program(f"No NeuronBridge version tag for {field[0]}")
+            variants = field[3].split(',') if len(field) == 4 else None
+            CONF['BATCH'].append((field[0], field[1], tag, variants))
+    if not CONF['BATCH']:
+        terminate_program(f"No libraries in {ARG.BATCH}")
+    LOGGER.info(f"Read {len(CONF['BATCH'])} libraries from {ARG.BATCH}")
+
+
 def create_config_object(config):
     """ Convert the JSON received from a configuration to an object
         Keyword arguments:
@@ -316,12 +642,14 @@ def create_config_object(config):
     return json.loads(json.dumps(data), object_hook=lambda dat: SimpleNamespace(**dat))
 
 
-def initialize_program():
-    """ Initialize
+def check_tokens(tokens):
+    """ Check that the required tokens are set and valid
+        Keyword arguments:
+          tokens: list of token environment variables
+        Returns:
+          None
     """
-    global LIBRARY # pylint: disable=W0603
-    LIBRARY = (call_responder('config', 'config/cdm_library'))["config"]
-    for tok in ['JACS_JWT', 'NEUPRINT_JWT']:
+    for tok in tokens:
         if tok not in os.environ:
             terminate_program(f"Missing token - set in {tok} environment variable")
         response = JRC.check_token(tok)
@@ -330,6 +658,46 @@ def initialize_program():
         elif tok == "JACS_JWT":
             CONF['FULL_NAME'] = response['payload']['full_name']
             LOGGER.info("Authenticated as %s", CONF['FULL_NAME'])
+
+
+def check_arguments():
+    """ Check for invalid combinations of arguments
+    """
+    if min(ARG.WORKERS, ARG.CONVERTERS, ARG.MONGO_BATCH, ARG.MONGO_WRITERS) < 1:
+        terminate_program("--workers, --converters, --mongo-batch, and --mongo-writers " \
+                          + "must be at least 1")
+    if ARG.PREFETCH < 0:
+        terminate_program("--prefetch can't be negative")
+    if ARG.SUBDIVISION_BYTES < 0:
+        terminate_program("--subdivision-bytes can't be negative")
+    if ARG.THUMBNAIL_WIDTH < 1:
+        terminate_program("--thumbnail-width must be at least 1")
+    if not 1 <= ARG.THUMBNAIL_QUALITY <= 95:
+        terminate_program("--thumbnail-quality must be between 1 and 95")
+    if ARG.PLAN and (ARG.WRITE or ARG.AWS or ARG.RESUME or ARG.EXECUTE):
+        terminate_program("--plan can't be used with --write, --aws, --resume, or --execute")
+    if ARG.BATCH and (ARG.LIBRARY or ARG.ALIGNMENT or ARG.DATASET or ARG.PLAN or ARG.EXECUTE
+                      or ARG.JOURNAL or ARG.PACKING or ARG.PUBLISHED or ARG.SLIDE
+                      or ARG.BACKCHECK):
+        terminate_program("--batch can't be used with --library, --alignment, --dataset, " \
+                          + "--plan, --execute, --journal, --packing, --published, --slide, " \
+                          + "or --backcheck")
+    if ARG.BATCH and not ARG.MANIFOLD:
+        terminate_program("--batch requires --manifold")
+    if ARG.SHARD:
+        field = re.fullmatch(r"(\d+)/(\d+)", ARG.SHARD)
+        if not field or int(field[1]) >= int(field[2]):
+            terminate_program(f"Invalid shard {ARG.SHARD} - must be i/n with 0 <= i < n")
+        CONF['SHARD'] = (int(field[1]), int(field[2]))
+        LOGGER.info(f"Processing shard {field[1]} of {field[2]}")
+
+
+def initialize_program():
+    """ Initialize
+    """
+    global LIBRARY # pylint: disable=W0603
+    LIBRARY = (call_responder('config', 'config/cdm_library'))["config"]
+    check_tokens(['JACS_JWT', 'NEUPRINT_JWT'])
     if not ARG.MANIFOLD:
         print("Select an AWS S3 manifold")
         terminal_menu = TerminalMenu(MANIFOLDS)
@@ -353,10 +721,13 @@ def initialize_program():
     # AWS S3
     initialize_s3()
     # Get parms
-    get_parms()
-    if ARG.LIBRARY not in LIBRARY:
-        terminate_program(f"Unknown library {ARG.LIBRARY}")
-    select_uploads()
+    if ARG.BATCH:
+        read_batch()
+    else:
+        get_parms()
+        if ARG.LIBRARY not in LIBRARY:
+            terminate_program(f"Unknown library {ARG.LIBRARY}")
+        select_uploads()
     # Get non-public slide codes
     coll = DBM['neuronbridge']['lmRelease']
     results = coll.find({"public": False})
@@ -385,11 +756,12 @@ def log_error(err_text, log_only=False):
     ERR.write(err_text + "\n")
 
 
-def get_s3_names(bucket, newname):
+def get_s3_names(bucket, newname, alignment_space=None):
     ''' Return an S3 bucket and prefixed object name
         Keyword arguments:
           bucket: base bucket
           newname: file to upload
+          alignment_space: alignment space (defaults to the current sample's)
         Returns:
           bucket and object name
     '''
@@ -400,7 +772,7 @@ def get_s3_names(bucket, newname):
     library = LIBRARY[ARG.LIBRARY]['name'].replace(' ', '_')
     if ARG.LIBRARY in CLOAD.version_required:
         library += '_v' + ARG.VERSION
-    object_name = '/'.join([REC['alignment_space'], library, newname])
+    object_name = '/'.join([alignment_space or REC['alignment_space'], library, newname])
     return bucket, object_name
 
 
@@ -417,14 +789,434 @@ def already_uploaded(ukey):
 
 
 
-def upload_aws(bucket, dirpath, fname, newname, force=False):
-    ''' Transfer a file to Amazon S3
+def unchanged(source, bucket, object_name):
+    ''' Determine if a source file was already uploaded to an S3 object and hasn't
+        changed since. The cache has the source's size, mtime, and MD5 checksum at the
+        time of the upload. A file with a different size has changed, and one with the
+        same size and mtime hasn't. If only the mtime differs (e.g. the file was copied
+        or touched), its checksum is compared.
+        Keyword arguments:
+          source: original source file path
+          bucket: S3 bucket
+          object_name: S3 object name
+        Returns:
+          True if the upload can be skipped, False otherwise
+    '''
+    if DIGEST['db'] is None or not ARG.AWS:
+        return False
+    key = '/'.join([bucket, object_name])
+    entry = DIGEST['db'].get(key)
+    if not entry or entry['source'] != source:
+        return False
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return False
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime_ns == entry['mtime']:
+        return True
+    if source_md5(source) != entry['md5']:
+        return False
+    entry['mtime'] = stat.st_mtime_ns
+    DIGEST['db'][key] = entry
+    return True
+
+
+def record_digest(source, bucket, object_name, md5):
+    ''' Record a completed upload in the digest cache
+        Keyword arguments:
+          source: original source file path
+          bucket: S3 bucket
+          object_name: S3 object name
+          md5: MD5 checksum of the source file
+        Returns:
+          None
+    '''
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return
+    DIGEST['db']['/'.join([bucket, object_name])] = {"source": source, "size": stat.st_size,
+                                                     "mtime": stat.st_mtime_ns, "md5": md5}
+
+
+def remember_md5(source, md5):
+    ''' Keep a source file's MD5 checksum so that it isn't computed again. Only the most
+        recent checksums (enough for the samples in the lookahead window) are kept.
+        Keyword arguments:
+          source: source file path
+          md5: MD5 checksum
+        Returns:
+          None
+    '''
+    DIGEST['md5'][source] = md5
+    while len(DIGEST['md5']) > ARG.CONVERTERS * 8 + 2:
+        del DIGEST['md5'][next(iter(DIGEST['md5']))]
+
+
+def source_md5(source):
+    ''' Return the MD5 checksum of a source file, computing it only if it isn't known
+        Keyword arguments:
+          source: source file path
+        Returns:
+          Hex digest
+    '''
+    md5 = DIGEST['md5'].get(source)
+    if md5 is None:
+        md5 = md5_file(source)
+        remember_md5(source, md5)
+    return md5
+
+
+def md5_file(fpath):
+    ''' Compute the MD5 checksum of a file
+        Keyword arguments:
+          fpath: file path
+        Returns:
+          Hex digest
+    '''
+    md5 = hashlib.md5()
+    with open(fpath, 'rb') as instream:
+        for chunk in iter(lambda: instream.read(1024 ** 2), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def put_object(complete_fpath, bucket, object_name, payload, source, md5=None):
+    ''' Transfer a single file to Amazon S3. This runs in an upload worker thread.
+        Images held in BUFFERED are streamed from memory rather than read from disk.
+        If the digest cache is in use and the source's checksum isn't known, a source
+        that's uploaded as is is read once for both the checksum and the upload.
+        Keyword arguments:
+          complete_fpath: file path to upload
+          bucket: S3 bucket
+          object_name: S3 object name
+          payload: ExtraArgs for the upload
+          source: original source file path (differs for converted images)
+          md5: MD5 checksum of the source (None if it isn't known)
+        Returns:
+          Number of bytes transferred and MD5 checksum of the source (if the digest
+          cache is in use)
+    '''
+    start = perf_counter()
+    data = BUFFERED.get(complete_fpath)
+    if DIGEST['db'] is None:
+        md5 = None
+    elif md5 is None and data is None and source == complete_fpath:
+        with open(complete_fpath, 'rb') as instream:
+            data = instream.read()
+        md5 = hashlib.md5(data).hexdigest()
+    if data is None:
+        S3_CLIENT.upload_file(complete_fpath, bucket, object_name, ExtraArgs=payload)
+        nbytes = os.path.getsize(complete_fpath)
+    else:
+        S3_CLIENT.upload_fileobj(io.BytesIO(data), bucket, object_name, ExtraArgs=payload)
+        nbytes = len(data)
+    if DIGEST['db'] is not None and md5 is None:
+        md5 = md5_file(source)
+    elapsed = perf_counter() - start
+    worker = threading.current_thread().name
+    with UPLOAD['lock']:
+        if worker not in WORKER:
+            WORKER[worker] = {'files': 0, 'bytes': 0, 'seconds': 0.0}
+        WORKER[worker]['files'] += 1
+        WORKER[worker]['bytes'] += nbytes
+        WORKER[worker]['seconds'] += elapsed
+    record_stage('upload', elapsed, nbytes)
+    return nbytes, md5
+
+
+def finish_uploads(return_when=ALL_COMPLETED):
+    ''' Wait for pending uploads and record their results. Samples whose last upload
+        has completed are written (or dropped if an upload failed).
+        Keyword arguments:
+          return_when: ALL_COMPLETED to drain the pool, FIRST_COMPLETED to free a slot
+        Returns:
+          None
+    '''
+    if not UPLOAD['pending']:
+        return
+    done, _ = wait(UPLOAD['pending'], return_when=return_when)
+    for future in done:
+        bucket, object_name, cleanup, source, held = UPLOAD['pending'].pop(future)
+        del UPLOAD['objects']['/'.join([bucket, object_name])]
+        err = future.exception()
+        if err:
+            # upload_file wraps S3 errors in S3UploadFailedError
+            if not isinstance(err, (ClientError, BotoCoreError, S3UploadFailedError)):
+                terminate_program(err)
+            LOGGER.critical(err)
+            log_error(f"Could not upload {object_name}: {err}", True)
+            COUNT['Amazon S3 upload errors'] += 1
+            forget_upload(object_name)
+            if cleanup in BUFFERED:
+                # Keep the image on disk so that the order file can be used to retry
+                with open(cleanup, 'wb') as outstream:
+                    outstream.write(BUFFERED.pop(cleanup))
+        else:
+            COUNT['Amazon S3 uploads'] += 1
+            md5 = future.result()[1]
+            if md5:
+                record_digest(source, bucket, object_name, md5)
+                remember_md5(source, md5)
+            if cleanup in BUFFERED:
+                del BUFFERED[cleanup]
+            elif cleanup:
+                os.remove(cleanup)
+        for rec in held:
+            rec['uploads'] -= 1
+            if err:
+                rec['failed'].append(object_name)
+            if rec['released'] and not rec['uploads']:
+                settle_sample(rec)
+
+
+def submit_upload(complete_fpath, bucket, object_name, payload, cleanup=None):
+    ''' Queue a file for transfer to Amazon S3. The number of uploads in flight is
+        bounded, so this will block until a worker is free.
+        Keyword arguments:
+          complete_fpath: file path to upload
+          bucket: S3 bucket
+          object_name: S3 object name
+          payload: ExtraArgs for the upload
+          cleanup: file to remove after a successful upload
+        Returns:
+          None
+    '''
+    if not UPLOAD['executor']:
+        UPLOAD['executor'] = ThreadPoolExecutor(max_workers=ARG.WORKERS,
+                                                thread_name_prefix='upload')
+    while len(UPLOAD['pending']) >= ARG.WORKERS * 4:
+        finish_uploads(FIRST_COMPLETED)
+    source = CONVERT['source'].get(complete_fpath, complete_fpath)
+    future = UPLOAD['executor'].submit(put_object, complete_fpath, bucket, object_name,
+                                       payload, source, DIGEST['md5'].get(source))
+    UPLOAD['pending'][future] = (bucket, object_name, cleanup, source, [])
+    UPLOAD['objects']['/'.join([bucket, object_name])] = future
+    hold_upload(bucket, object_name)
+
+
+def hold_sample(smp, document=None):
+    ''' Start holding the output for a sample. Uploads submitted (or already in flight)
+        for the sample's objects until release_sample() is called are tied to it.
+        Keyword arguments:
+          smp: sample record (None when executing a plan)
+          document: publishedURL document (when executing a plan)
+        Returns:
+          None
+    '''
+    UPLOAD['sample'] = {'smp': smp, 'document': document, 'uploads': 0, 'failed': [],
+                        'keys': [], 'released': False}
+
+
+def hold_upload(bucket, object_name):
+    ''' Tie an upload in flight to the sample being processed
+        Keyword arguments:
+          bucket: S3 bucket
+          object_name: S3 object name
+        Returns:
+          None
+    '''
+    future = UPLOAD['objects'].get('/'.join([bucket, object_name]))
+    if UPLOAD['sample'] is None or future is None:
+        return
+    UPLOAD['pending'][future][4].append(UPLOAD['sample'])
+    UPLOAD['sample']['uploads'] += 1
+
+
+def release_sample(write=True):
+    ''' Stop holding the output for the sample being processed. It's written now if
+        its uploads have completed, and otherwise when the last one completes.
+        Keyword arguments:
+          write: write the sample (False if it was rejected)
+        Returns:
+          None
+    '''
+    rec = UPLOAD['sample']
+    UPLOAD['sample'] = None
+    # Later duplicates of the sample's images are found with uploaded_source()
+    CONVERT['done'].clear()
+    CONVERT['source'].clear()
+    if rec is None or not write:
+        return
+    rec['released'] = True
+    if not rec['uploads']:
+        settle_sample(rec)
+
+
+def settle_sample(rec):
+    ''' Write a sample to the JSON output and publishedURL once all of its uploads
+        have completed. A sample with a failed upload is dropped and left out of the
+        journal, so that it will be retried.
+        Keyword arguments:
+          rec: held sample
+        Returns:
+          None
+    '''
+    smp = rec['smp']
+    if rec['failed']:
+        ident = smp['_id'] if smp else rec['document']['_id']
+        log_error(f"Did not write {ident} - could not upload {', '.join(rec['failed'])}")
+        COUNT['Samples not written'] += 1
+        if smp and smp['_id'] in JOURNAL['samples']:
+            JOURNAL['samples'].remove(smp['_id'])
+        return
+    for object_name in rec['keys']:
+        write_key(object_name)
+    if smp is None:
+        if ARG.WRITE:
+            queue_upsert(rec['document'])
+        return
+    write_sample(smp)
+    if ARG.WRITE or ARG.PLAN:
+        add_image_to_mongo(smp)
+
+
+def shutdown_uploads():
+    ''' Drain pending uploads, stop the upload workers, and report their throughput
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not UPLOAD['executor']:
+        return
+    finish_uploads()
+    UPLOAD['executor'].shutdown()
+    UPLOAD['executor'] = None
+    if not WORKER:
+        return
+    print("Upload worker throughput:")
+    total = {'files': 0, 'bytes': 0}
+    for worker, stat in sorted(WORKER.items()):
+        total['files'] += stat['files']
+        total['bytes'] += stat['bytes']
+        rate = stat['bytes'] / stat['seconds'] / 1024 ** 2 if stat['seconds'] else 0
+        print(f"  {worker + ':' : <21} {stat['files']:,} files, " \
+              + f"{stat['bytes'] / 1024 ** 2:,.1f}MB, {rate:,.2f}MB/sec")
+    LOGGER.info(f"{len(WORKER)} upload workers transferred {total['files']:,} files " \
+                + f"({total['bytes'] / 1024 ** 2:,.1f}MB)")
+
+
+def upload_payload(mimetype):
+    ''' Return the ExtraArgs for an S3 upload
+        Keyword arguments:
+          mimetype: MIME type of the object
+        Returns:
+          ExtraArgs dictionary
+    '''
+    payload = {'ContentType': mimetype}
+    if ARG.MANIFOLD == 'prod':
+        payload['ACL'] = 'public-read'
+    return payload
+
+
+def compact_path(path):
+    ''' Return a compact form of a path: the index of its (interned) directory prefix
+        and its file name. Libraries have millions of objects but only a few thousand
+        directories, so each directory is only kept once.
+        Keyword arguments:
+          path: S3 object name or filepath
+        Returns:
+          Compact path
+    '''
+    dirpath, _, fname = path.rpartition('/')
+    idx = UPLOADED['index'].get(dirpath)
+    if idx is None:
+        idx = UPLOADED['index'][dirpath] = len(UPLOADED['prefixes'])
+        UPLOADED['prefixes'].append(dirpath)
+    return f"{idx}/{fname}"
+
+
+def expand_path(value):
+    ''' Return the path for a compact path
+        Keyword arguments:
+          value: compact path (str, or bytes from the name store)
+        Returns:
+          Path
+    '''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    idx, _, fname = value.partition('/')
+    return '/'.join([UPLOADED['prefixes'][int(idx)], fname])
+
+
+def uploaded_source(object_name):
+    ''' Return the filepath an object was uploaded from during this run
+        Keyword arguments:
+          object_name: S3 object name
+        Returns:
+          Source filepath (None if the object hasn't been uploaded)
+    '''
+    value = UPLOADED['names'].get(compact_path(object_name))
+    return None if value is None else expand_path(value)
+
+
+def record_upload(object_name, complete_fpath):
+    ''' Record the filepath an object is uploaded from
+        Keyword arguments:
+          object_name: S3 object name
+          complete_fpath: source filepath
+        Returns:
+          None
+    '''
+    UPLOADED['names'][compact_path(object_name)] = compact_path(complete_fpath)
+
+
+def forget_upload(object_name):
+    ''' Forget an object whose upload failed, so that it isn't treated as uploaded by
+        later samples or a resumed run
+        Keyword arguments:
+          object_name: S3 object name
+        Returns:
+          None
+    '''
+    key = compact_path(object_name)
+    if key in UPLOADED['names']:
+        del UPLOADED['names'][key]
+    if JOURNAL['keys']:
+        JOURNAL['keys'] = [key for key in JOURNAL['keys'] if key[0] != object_name]
+
+
+def open_name_store():
+    ''' Open the disk-backed store of uploaded object names (if --name-store is set)
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not ARG.NAME_STORE:
+        return
+    try:
+        UPLOADED['names'] = dbm.open(ARG.NAME_STORE, 'n')
+    except Exception as err:
+        terminate_program(err)
+    LOGGER.info(f"Opened uploaded name store {ARG.NAME_STORE}")
+
+
+def close_name_store():
+    ''' Close the disk-backed store of uploaded object names
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not isinstance(UPLOADED['names'], dict):
+        UPLOADED['names'].close()
+        UPLOADED['names'] = {}
+
+
+def upload_aws(bucket, dirpath, fname, newname, force=False, cleanup=False):
+    ''' Transfer a file to Amazon S3. Transfers are handed to a pool of upload workers,
+        so failures are reported when the upload completes.
         Keyword arguments:
           bucket: S3 bucket
           dirpath: source directory
           fname: file name
           newname: new file name
           force: force upload (regardless of AWS parm)
+          cleanup: remove the source file after it is uploaded
         Returns:
           url: intended URL
           skip: do not write or perform postprocessing
@@ -433,9 +1225,10 @@ def upload_aws(bucket, dirpath, fname, newname, force=False):
     bucket, object_name = get_s3_names(bucket, newname)
     url = '/'.join([AWS.base_aws_url, bucket, object_name])
     url = url.replace(' ', '+')
-    if object_name in UPLOADED_NAME:
-        if complete_fpath != UPLOADED_NAME[object_name]:
-            err_text = f"{object_name} was already uploaded from {UPLOADED_NAME[object_name]}, " \
+    previous = uploaded_source(object_name)
+    if previous is not None:
+        if complete_fpath != previous:
+            err_text = f"{object_name} was already uploaded from {previous}, " \
                        + f"but is now being uploaded from {complete_fpath}"
             LOGGER.error(err_text)
             ERR.write(err_text + "\n")
@@ -443,20 +1236,45 @@ def upload_aws(bucket, dirpath, fname, newname, force=False):
             return False, False
         LOGGER.debug("Already uploaded %s", object_name)
         COUNT['Duplicate objects'] += 1
+        hold_upload(bucket, object_name)
         return url, True
     COUNT['Files to upload'] += 1
-    UPLOADED_NAME[object_name] = complete_fpath
+    record_upload(object_name, complete_fpath)
+    if JOURNAL['stream']:
+        JOURNAL['keys'].append([object_name, complete_fpath])
     if "/searchable_neurons/" in object_name:
-        KEY_LIST.append(object_name)
-    if not os.path.exists(complete_fpath):
-        msg = f"File {complete_fpath} does not exist"
+        if UPLOAD['sample'] is None:
+            write_key(object_name)
+        else:
+            # The key is written with the sample, so that it's left out if an upload fails
+            UPLOAD['sample']['keys'].append(object_name)
+    source = CONVERT['source'].get(complete_fpath, complete_fpath)
+    if unchanged(source, bucket, object_name):
+        LOGGER.debug(f"{object_name} is unchanged since it was last uploaded")
+        COUNT['Unchanged objects'] += 1
+        return url, False
+    # When planning, images that need conversion haven't been converted yet
+    check_fpath = source if ARG.PLAN else complete_fpath
+    if check_fpath not in BUFFERED and not os.path.exists(check_fpath):
+        msg = f"File {check_fpath} does not exist"
         COUNT['Images not found'] += 1
         terminate_program(msg) if ARG.WRITE else log_error(msg, True)
         return url, False
     LOGGER.debug(f"Uploading {complete_fpath} to S3 as {object_name}")
     if ARG.MANIFEST and already_uploaded(object_name):
         return
-    S3CP.write(f"{complete_fpath}\t{'/'.join([bucket, object_name])}\n")
+    if newname.endswith('.png'):
+        mimetype = 'image/png'
+    elif newname.endswith('.jpg'):
+        mimetype = 'image/jpeg'
+    else:
+        mimetype = 'image/tiff'
+    if ARG.PLAN:
+        COUNT['Images processed'] += 1
+        write_plan([source, bucket, object_name, os.path.getsize(source), mimetype,
+                    int(source != complete_fpath), ''])
+        return url, False
+    write_order(f"{complete_fpath}\t{'/'.join([bucket, object_name])}\n")
     if ARG.AWS:
         LOGGER.info("Upload %s", object_name)
     COUNT['Images processed'] += 1
@@ -465,23 +1283,8 @@ def upload_aws(bucket, dirpath, fname, newname, force=False):
     if not ARG.AWS:
         COUNT['Amazon S3 uploads'] += 1
         return url, False
-    if newname.endswith('.png'):
-        mimetype = 'image/png'
-    elif newname.endswith('.jpg'):
-        mimetype = 'image/jpeg'
-    else:
-        mimetype = 'image/tiff'
-    try:
-        payload = {'ContentType': mimetype}
-        if ARG.MANIFOLD == 'prod':
-            payload['ACL'] = 'public-read'
-        S3_CLIENT.upload_file(complete_fpath, bucket,
-                              object_name,
-                              ExtraArgs=payload)
-    except ClientError as err:
-        LOGGER.critical(err)
-        return False, False
-    COUNT['Amazon S3 uploads'] += 1
+    submit_upload(complete_fpath, bucket, object_name, upload_payload(mimetype),
+                  complete_fpath if cleanup else None)
     return url, False
 
 
@@ -538,6 +1341,23 @@ def get_image_mapping(publishing_db):
         RELEASE[row['workstation_sample_id']] = row['alps_release']
 
 
+def load_mappings(publishing_db):
+    ''' Load the line/driver and sample/release mappings for a publishing database.
+        The mappings are cached, so a batch only reads each publishing database once.
+        Keyword arguments:
+          publishing_db: publishing database
+        Returns:
+          None
+    '''
+    global DRIVER, RELEASE # pylint: disable=W0603
+    if publishing_db not in MAPPING:
+        DRIVER, RELEASE = {}, {}
+        get_line_mapping(publishing_db)
+        get_image_mapping(publishing_db)
+        MAPPING[publishing_db] = (DRIVER, RELEASE)
+    DRIVER, RELEASE = MAPPING[publishing_db]
+
+
 def backcheck(data):
     ''' Backcheck publishing database contents versus JSON data
         Keyword arguments:
@@ -555,23 +1375,294 @@ def backcheck(data):
     terminate_program("Backcheck performed")
 
 
-def convert_file(sourcepath, newname):
-    ''' Convert file to PNG format
+def encode_thumbnail(image, width=THUMBNAIL_WIDTH, quality=THUMBNAIL_QUALITY):
+    ''' Make a JPEG thumbnail from a decoded image. The image is first reduced by an
+        integer factor, which is much faster than resampling it at full resolution.
         Keyword arguments:
-          sourcepath: source filepath
-          newname: new file name
+          image: PIL image
+          width: largest thumbnail width and height (pixels)
+          quality: JPEG quality
         Returns:
-          New filepath
+          JPEG bytes
     '''
-    LOGGER.debug("Converting %s to %s", sourcepath, newname)
-    newpath = CLOAD.temp_dir + newname
-    if not ARG.WRITE:
-        return newpath
-    with Image.open(sourcepath) as image:
-        image.save(newpath, 'PNG')
-    return newpath
-
-
+    small = image if image.mode in ('RGB', 'RGBA', 'L') else image.convert('RGB')
+    factor = small.width // width
+    small = small.reduce(factor) if factor > 1 else small.copy()
+    if small.mode == 'RGBA':
+        small = small.convert('RGB')
+    small.thumbnail((width, width))
+    buffer = io.BytesIO()
+    small.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def thumbnail_options():
+    ''' Return the thumbnail width and JPEG quality to pass to encode_png. These are
+        passed explicitly since the conversion workers don't have the arguments.
+        Keyword arguments:
+          None
+        Returns:
+          Tuple of width and quality, or None if thumbnails aren't being made
+    '''
+    return (ARG.THUMBNAIL_WIDTH, ARG.THUMBNAIL_QUALITY) if ARG.THUMBNAILS else None
+
+
+def encode_png(sourcepath, newpath, limit=0, thumbnail=None, digest=False):
+    ''' Convert an image to PNG format, and optionally make a thumbnail from the same
+        decoded image. This runs in a conversion worker process.
+        Keyword arguments:
+          sourcepath: source filepath
+          newpath: PNG filepath (None to only make the thumbnail)
+          limit: largest PNG (in bytes) to return in memory instead of writing to newpath
+          thumbnail: thumbnail width and JPEG quality (None for no thumbnail)
+          digest: compute the source's MD5 checksum from the same read
+        Returns:
+          PNG bytes (None if the PNG was written to newpath), thumbnail bytes, and MD5
+          checksum (None if it wasn't requested)
+    '''
+    png = thumb = md5 = None
+    source = sourcepath
+    if digest:
+        with open(sourcepath, 'rb') as instream:
+            source = io.BytesIO(instream.read())
+        md5 = hashlib.md5(source.getbuffer()).hexdigest()
+    with Image.open(source) as image:
+        if thumbnail:
+            thumb = encode_thumbnail(image, *thumbnail)
+        if not newpath:
+            return png, thumb, md5
+        if not limit:
+            image.save(newpath, 'PNG')
+            return png, thumb, md5
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+    if buffer.tell() <= limit:
+        return buffer.getvalue(), thumb, md5
+    with open(newpath, 'wb') as outstream:
+        outstream.write(buffer.getbuffer())
+    return png, thumb, md5
+
+
+def buffer_limit():
+    ''' Return the largest converted image (in bytes) to keep in memory. Images are only
+        kept in memory when they will be uploaded by this program; otherwise the order
+        file needs them on disk.
+        Keyword arguments:
+          None
+        Returns:
+          Size in bytes (0 to always write to disk)
+    '''
+    return int(ARG.BUFFER_LIMIT * 1024 ** 2) if ARG.AWS else 0
+
+
+def conversion_candidate(smp):
+    ''' Return the source path and PNG name for a sample whose primary image will be
+        converted (or thumbnailed), or None if it won't be
+        Keyword arguments:
+          smp: sample record (before remapping)
+        Returns:
+          Source filepath and new file name (None for a thumbnail only), or None
+    '''
+    if (not ARG.WRITE) or (ARG.LIBRARY.startswith('flylight') and not ARG.THUMBNAILS):
+        return None
+    if smp.get('alignmentSpace') != ARG.ALIGNMENT or not smp.get('publishedName'):
+        return None
+    if 'SourceColorDepthImage' not in smp.get('computeFiles', {}):
+        return None
+    if (not ARG.REWRITE) and int(smp['_id']) in PUBLISHED_ID:
+        return None
+    if smp['_id'] in JOURNAL['committed']:
+        return None
+    sourcepath = smp['computeFiles']['SourceColorDepthImage']
+    if ARG.LIBRARY.startswith('flylight'):
+        # Skip samples that the main loop (and check_image) will reject
+        sid = smp.get('sourceRefId', '').split('#')[-1]
+        if smp.get('slideCode') in NON_PUBLIC or sid not in RELEASE \
+           or (ARG.RELEASE and ARG.RELEASE != RELEASE[sid]):
+            return None
+        # FlyLight images are already PNGs, so only the thumbnail is needed
+        return sourcepath, None
+    newname = f"{smp['publishedName']}-{smp['alignmentSpace']}-CDM.png"
+    # This runs ahead of the main loop, so the sample's own alignment space is used
+    bucket, object_name = get_s3_names(AWS.s3_bucket.cdm, newname, smp['alignmentSpace'])
+    if uploaded_source(object_name) is not None:
+        return None
+    if not unchanged(sourcepath, bucket, object_name):
+        return sourcepath, newname
+    thumbname = newname.replace('.png', '.jpg')
+    if ARG.THUMBNAILS and not unchanged(sourcepath, *get_s3_names(
+            getattr(AWS.s3_bucket, "cdm-thumbnail"), thumbname, smp['alignmentSpace'])):
+        return sourcepath, None
+    return None
+
+
+def submit_conversion(sourcepath, newname):
+    ''' Submit a conversion (and thumbnail, if requested) to the process pool. Thumbnail
+        futures are also kept in CONVERT['thumbnails'] (keyed by source filepath).
+        Keyword arguments:
+          sourcepath: source filepath
+          newname: PNG file name (None to only make the thumbnail)
+        Returns:
+          None
+    '''
+    newpath = CLOAD.temp_dir + newname if newname else None
+    if newpath and (newpath in CONVERT['pending'] or newpath in CONVERT['done']):
+        return
+    if (not newpath) and sourcepath in CONVERT['thumbnails']:
+        return
+    if not CONVERT['executor']:
+        # Spawn (rather than fork) since the upload workers are threads
+        CONVERT['executor'] = ProcessPoolExecutor(max_workers=ARG.CONVERTERS,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+    future = CONVERT['executor'].submit(encode_png, sourcepath, newpath, buffer_limit(),
+                                        thumbnail_options(), DIGEST['db'] is not None)
+    if newpath:
+        CONVERT['pending'][newpath] = future
+    if ARG.THUMBNAILS:
+        CONVERT['thumbnails'][sourcepath] = future
+
+
+def lookahead(data, candidate_func=conversion_candidate):
+    ''' Yield samples, submitting PNG conversions to a process pool for the samples that
+        are up to --converters * 4 positions ahead of the one being processed
+        Keyword arguments:
+          data: iterable of samples (or plan rows)
+          candidate_func: function returning the source path and PNG name to convert
+        Returns:
+          Generator of samples
+    '''
+    window = collections.deque()
+    depth = ARG.CONVERTERS * 4
+    for smp in data:
+        window.append(smp)
+        candidate = candidate_func(smp)
+        if candidate:
+            submit_conversion(*candidate)
+        if len(window) > depth:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+
+def shutdown_conversions():
+    ''' Stop the conversion workers and remove PNGs that were converted but not used
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not CONVERT['executor']:
+        return
+    for newpath, future in CONVERT['pending'].items():
+        if future.cancel():
+            continue
+        try:
+            if future.result()[0] is None:
+                os.remove(newpath)
+        except Exception as err:
+            LOGGER.warning(f"Unused conversion of {newpath} failed: {err}")
+    CONVERT['pending'].clear()
+    for thumb in CONVERT['thumbnails'].values():
+        if not isinstance(thumb, bytes):
+            thumb.cancel()
+    CONVERT['thumbnails'].clear()
+    CONVERT['executor'].shutdown()
+    CONVERT['executor'] = None
+
+
+def convert_file(sourcepath, newname):
+    ''' Convert file to PNG format. Conversions that were started ahead of time by
+        lookahead() are collected from the process pool. PNGs under --buffer-limit are
+        kept in BUFFERED rather than written to CLOAD.temp_dir.
+        Keyword arguments:
+          sourcepath: source filepath
+          newname: new file name
+        Returns:
+          New filepath
+    '''
+    LOGGER.debug("Converting %s to %s", sourcepath, newname)
+    newpath = CLOAD.temp_dir + newname
+    if ARG.PLAN:
+        # The conversion is done when the plan is executed
+        CONVERT['source'][newpath] = sourcepath
+    if not ARG.WRITE or newpath in CONVERT['done']:
+        return newpath
+    CONVERT['source'][newpath] = sourcepath
+    bucket, object_name = get_s3_names(AWS.s3_bucket.cdm, newname)
+    if uploaded_source(object_name) is not None:
+        # upload_aws will report this as a duplicate of an image converted earlier
+        return newpath
+    if unchanged(sourcepath, bucket, object_name):
+        # upload_aws will skip this image, so there's no need to convert it
+        CONVERT['done'].add(newpath)
+        return newpath
+    collect_conversion(sourcepath, newpath)
+    return newpath
+
+
+def collect_conversion(sourcepath, newpath):
+    ''' Collect a conversion from the process pool, or convert the file now if it
+        wasn't submitted ahead of time
+        Keyword arguments:
+          sourcepath: source filepath
+          newpath: PNG filepath
+        Returns:
+          None
+    '''
+    start = perf_counter()
+    future = CONVERT['pending'].pop(newpath, None)
+    if future:
+        data, _, md5 = future.result()
+    else:
+        data, thumb, md5 = encode_png(sourcepath, newpath, buffer_limit(), thumbnail_options(),
+                                      DIGEST['db'] is not None)
+        if ARG.THUMBNAILS:
+            CONVERT['thumbnails'][sourcepath] = thumb
+    if md5:
+        remember_md5(sourcepath, md5)
+    # Conversions that ran ahead only count the time the main loop waited for them
+    record_stage('convert', perf_counter() - start, os.path.getsize(sourcepath))
+    if data is not None:
+        BUFFERED[newpath] = data
+    CONVERT['done'].add(newpath)
+
+
+def discard_thumbnail(smp):
+    ''' Discard the thumbnail made ahead of time for a sample that was rejected
+        Keyword arguments:
+          smp: sample record
+        Returns:
+          None
+    '''
+    thumb = CONVERT['thumbnails'].pop(smp.get('computeFiles', {}).get('SourceColorDepthImage'),
+                                      None)
+    # FlyEM thumbnails share a future with the PNG conversion, which is cleaned up later
+    if thumb is not None and not isinstance(thumb, bytes) \
+       and ARG.LIBRARY.startswith('flylight'):
+        thumb.cancel()
+
+
+def take_thumbnail(sourcepath):
+    ''' Return the thumbnail for a source image. Thumbnails are normally made by the
+        worker that converted (or read ahead) the image; otherwise it's made now.
+        Keyword arguments:
+          sourcepath: source filepath
+        Returns:
+          JPEG bytes
+    '''
+    thumb = CONVERT['thumbnails'].pop(sourcepath, None)
+    if isinstance(thumb, bytes):
+        return thumb
+    if thumb is None:
+        _, thumb, md5 = encode_png(sourcepath, None, thumbnail=thumbnail_options(),
+                                   digest=DIGEST['db'] is not None)
+    else:
+        _, thumb, md5 = thumb.result()
+    if md5:
+        remember_md5(sourcepath, md5)
+    return thumb
+
+
 def process_flyem(smp, convert=True):
     ''' Return the file name for a FlyEM sample. The new name will be the
         body ID followed by the alignment space and the CDM suffix.
@@ -780,6 +1871,38 @@ def add_searchable_neuron(smp, url):
     smp['uploaded']['searchable_neurons'] = new_url
 
 
+def searchable_subdivision(ancname, fpath):
+    ''' Assign a searchable_neurons object to a subdivision. Subdivisions are filled
+        to --subdivision-bytes (or to SUBDIVISION['limit'] objects), and objects that
+        are in the packing file keep the subdivision recorded there.
+        Keyword arguments:
+          ancname: object name (searchable_neurons/<file name>)
+          fpath: source file path
+        Returns:
+          Object name with the subdivision
+    '''
+    if ancname in PACKING:
+        prefix = PACKING[ancname]
+    else:
+        size = os.path.getsize(fpath) if os.path.exists(fpath) else 0
+        if ARG.SUBDIVISION_BYTES:
+            full = SUBDIVISION['counter'] and \
+                   SUBDIVISION['bytes'] + size > ARG.SUBDIVISION_BYTES * 1024 ** 2
+        else:
+            full = SUBDIVISION['counter'] >= SUBDIVISION['limit']
+        if full:
+            LOGGER.debug(f"Subdivision {SUBDIVISION['prefix']} has {SUBDIVISION['counter']:,} " \
+                         + f"objects ({SUBDIVISION['bytes']:,} bytes)")
+            SUBDIVISION['prefix'] += SUBDIVISION['stride']
+            SUBDIVISION['counter'] = SUBDIVISION['bytes'] = 0
+        SUBDIVISION['counter'] += 1
+        SUBDIVISION['bytes'] += size
+        prefix = SUBDIVISION['prefix']
+        if OUTPUT['packing']:
+            OUTPUT['packing'].write(f"{ancname}\t{prefix}\t{size}\n")
+    return ancname.replace('searchable_neurons/', f"searchable_neurons/{prefix}/")
+
+
 def upload_flyem_variants(smp, newname):
     ''' Upload variant files for FlyEM
         Keyword arguments:
@@ -810,12 +1933,7 @@ def upload_flyem_variants(smp, newname):
         dirpath = os.path.dirname(smp['variants'][variant])
         fname = os.path.basename(smp['variants'][variant])
         if variant == 'searchable_neurons':
-            if SUBDIVISION['counter'] >= SUBDIVISION['limit']:
-                SUBDIVISION['prefix'] += 1
-                SUBDIVISION['counter'] = 0
-            ancname = ancname.replace('searchable_neurons/',
-                                      f"searchable_neurons/{str(SUBDIVISION['prefix'])}/")
-            SUBDIVISION['counter'] += 1
+            ancname = searchable_subdivision(ancname, smp['variants'][variant])
         url, _ = upload_aws(AWS.s3_bucket.cdm, dirpath, fname, ancname)
         if not url:
             LOGGER.warning(f"Skipping {variant} for {smp['name']} - no URL")
@@ -885,12 +2003,7 @@ def upload_flylight_variants(smp, newname):
         #print(fname)
         #print(ancname)
         if variant == 'searchable_neurons':
-            if SUBDIVISION['counter'] >= SUBDIVISION['limit']:
-                SUBDIVISION['prefix'] += 1
-                SUBDIVISION['counter'] = 0
-            ancname = ancname.replace('searchable_neurons/',
-                                      f"searchable_neurons/{str(SUBDIVISION['prefix'])}/")
-            SUBDIVISION['counter'] += 1
+            ancname = searchable_subdivision(ancname, smp['variants'][variant])
         url, _ = upload_aws(AWS.s3_bucket.cdm, dirpath, fname, ancname)
         if not url:
             LOGGER.warning(f"Skipping {variant} for {smp['name']} - no URL")
@@ -930,10 +2043,8 @@ def check_image(smp):
             COUNT['Skipped release'] += 1
             return False
         smp['alpsRelease'] = RELEASE[sid]
-    # Check Mongo
-    coll = DBM['neuronbridge'].publishedURL
-    result = coll.find_one({'_id': int(smp['_id'])})
-    if result and not ARG.REWRITE:
+    # Check Mongo (publishedURL IDs are loaded up front by get_published_ids)
+    if (not ARG.REWRITE) and int(smp['_id']) in PUBLISHED_ID:
         COUNT['Already in Mongo'] += 1
         return False
     COUNT['Not in Mongo'] += 1
@@ -955,7 +2066,9 @@ def upload_primary(smp, newname):
     '''
     dirpath = os.path.dirname(smp['filepath'])
     fname = os.path.basename(smp['filepath'])
-    url, skipped = upload_aws(AWS.s3_bucket.cdm, dirpath, fname, newname)
+    # Converted FlyEM images are removed once the upload worker has transferred them
+    cleanup = ARG.WRITE and (not ARG.LIBRARY.startswith('flylight'))
+    url, skipped = upload_aws(AWS.s3_bucket.cdm, dirpath, fname, newname, cleanup=cleanup)
     if url:
         # Always write CDM URLs to smp[uploaded]
         if "uploaded" not in smp:
@@ -963,16 +2076,44 @@ def upload_primary(smp, newname):
         smp['uploaded']['cdm'] = url
         turl = produce_thumbnail(url)
         smp['uploaded']['cdm_thumbnail'] = turl
-        if not skipped:
-            if ARG.WRITE:
-                if ARG.AWS and (not ARG.LIBRARY.startswith('flylight')):
-                    os.remove(smp['filepath'])
-            elif ARG.AWS:
-                LOGGER.info("Primary %s", url)
+        if (not skipped) and (not ARG.WRITE) and ARG.AWS:
+            LOGGER.info("Primary %s", url)
+        if ARG.THUMBNAILS and (ARG.WRITE or ARG.PLAN) and not skipped:
+            upload_thumbnail(smp, newname)
     elif ARG.WRITE:
         LOGGER.error("Did not transfer primary image %s", fname)
 
 
+def upload_thumbnail(smp, newname):
+    ''' Upload a thumbnail of the primary image to the thumbnail bucket. Thumbnails are
+        held in memory when they will be uploaded by this program, and are otherwise
+        written to the temp directory for the order file.
+        Keyword arguments:
+          smp: sample record
+          newname: primary image file name
+        Returns:
+          None
+    '''
+    sourcepath = CONVERT['source'].get(smp['filepath'], smp['filepath'])
+    bucket = getattr(AWS.s3_bucket, "cdm-thumbnail")
+    thumbname = newname.replace('.png', '.jpg')
+    thumbpath = CLOAD.temp_dir + thumbname
+    # Thumbnails are cached (and planned) by the image they're made from
+    CONVERT['source'][thumbpath] = sourcepath
+    if ARG.PLAN:
+        # The thumbnail is made when the plan is executed
+        pass
+    elif unchanged(sourcepath, *get_s3_names(bucket, thumbname)):
+        # upload_aws will skip this thumbnail, so there's no need to make it
+        CONVERT['thumbnails'].pop(sourcepath, None)
+    elif ARG.AWS:
+        BUFFERED[thumbpath] = take_thumbnail(sourcepath)
+    else:
+        with open(thumbpath, 'wb') as outstream:
+            outstream.write(take_thumbnail(sourcepath))
+    upload_aws(bucket, os.path.dirname(thumbpath), thumbname, thumbname, cleanup=ARG.AWS)
+
+
 def handle_primary(smp):
     ''' Handle the primary image
         Keyword arguments:
@@ -1043,6 +2184,13 @@ def confirm_run():
         Returns:
           True or False
     '''
+    if 'CONFIRMED' in CONF:
+        return CONF['CONFIRMED']
+    if ARG.BATCH:
+        print("Batch:")
+        for library, alignment, tag, variants in CONF['BATCH']:
+            print(f"  {library} {alignment} (version {tag})" \
+                  + (f": {', '.join(variants)}" if variants else ""))
     print(f"MySQL manifold:       {ARG.MYSQL}")
     print(f"MongoDB manifold:     {ARG.MONGO}")
     print(f"S3 manifold:          {ARG.MANIFOLD}")
@@ -1056,21 +2204,27 @@ def confirm_run():
     print(f"Required products:    {', '.join(REQUIRED_PRODUCTS)}")
     print(f"Upload files to AWS:  {'Yes' if ARG.AWS else 'No'}")
     print(f"Update MongoDB:       {'Yes' if ARG.WRITE else 'No'}")
+    if ARG.PLAN:
+        print(f"Plan file:            {ARG.PLAN}")
+    if ARG.YES or ARG.BATCH:
+        # Batch runs aren't interactive
+        CONF['CONFIRMED'] = True
+        return True
     print("Do you want to proceed?")
     allowed = ['No', 'Yes']
     terminal_menu = TerminalMenu(allowed)
     chosen = terminal_menu.show()
-    if chosen is None or allowed[chosen] != "Yes":
-        return False
-    return True
+    CONF['CONFIRMED'] = chosen is not None and allowed[chosen] == "Yes"
+    return CONF['CONFIRMED']
 
 
-def read_json():
-    ''' Read in JSON from a text file or from MongoDB.
+def read_json(fields=None):
+    ''' Open a streaming cursor on the library's neuronMetadata documents (in _id order).
+        Full documents are returned, since they're written to the JSON output.
         Keyword arguments:
-          None
+          fields: list of fields to return (for passes that don't write output)
         Returns:
-          JSON
+          Number of documents and cursor
     '''
     stime = datetime.now()
     print(f"Loading JSON from Mongo for {ARG.LIBRARY}")
@@ -1085,23 +2239,115 @@ def read_json():
         payload["slideCode"] = ARG.SLIDE
     if ARG.ALIGNMENT:
         payload['alignmentSpace'] = ARG.ALIGNMENT
+    if 'SHARD' in CONF:
+        payload['_id'] = {"$mod": [CONF['SHARD'][1], CONF['SHARD'][0]]}
     LOGGER.info("Checking neuronMetadata for %s library entries tagged as %s",
                 ARG.LIBRARY, ARG.TAG)
-    data = list(coll.find(payload, allow_disk_use=True).sort("slide_code", 1))
+    project = dict.fromkeys(fields, 1) if fields else None
+    try:
+        count = coll.count_documents(payload)
+        data = coll.find(payload, project, no_cursor_timeout=True,
+                         batch_size=1000).sort("_id", 1)
+    except Exception as err:
+        terminate_program(err)
+    # The read_json stage only has the time spent waiting for documents (see prefetch)
     time_diff = datetime.now() - stime
-    LOGGER.info("JSON read in %fsec", time_diff.total_seconds())
-    print(f"Documents read from Mongo: {len(data):,}")
-    return data
+    LOGGER.info("JSON counted in %fsec", time_diff.total_seconds())
+    print(f"Documents to read from Mongo: {count:,}")
+    return count, data
+
+
+def write_upserts(batch):
+    ''' Write a batch of publishedURL upserts as a single unordered bulk write. This
+        runs in a Mongo writer thread.
+        Keyword arguments:
+          batch: list of publishedURL documents
+        Returns:
+          Bulk write details and elapsed seconds
+    '''
+    coll = DBM['neuronbridge'].publishedURL
+    ops = [UpdateOne({"_id": payload['_id']}, {"$set": payload}, upsert=True)
+           for payload in batch]
+    start = perf_counter()
+    try:
+        result = coll.bulk_write(ops, ordered=False)
+        details = {"nUpserted": result.upserted_count, "nMatched": result.matched_count,
+                   "writeErrors": []}
+    except BulkWriteError as err:
+        details = err.details
+    except Exception as err:
+        LOGGER.error(f"Bulk write of {len(batch):,} documents failed: {err}")
+        details = {"nUpserted": 0, "nMatched": 0,
+                   "writeErrors": [{"index": idx, "errmsg": str(err)}
+                                   for idx in range(len(batch))]}
+    return details, perf_counter() - start
+
+
+def finish_mongo(return_when=ALL_COMPLETED):
+    ''' Wait for bulk writes in flight and record their results
+        Keyword arguments:
+          return_when: ALL_COMPLETED to wait for all writes, FIRST_COMPLETED to free a writer
+        Returns:
+          None
+    '''
+    if not MONGO_WRITE['pending']:
+        return
+    done, _ = wait(MONGO_WRITE['pending'], return_when=return_when)
+    for future in done:
+        batch = MONGO_WRITE['pending'].pop(future)
+        details, seconds = future.result()
+        for werr in details['writeErrors']:
+            log_error(f"Could not insert {batch[werr['index']]['_id']} into Mongo: " \
+                      + werr['errmsg'])
+            COUNT["Mongo errors"] += 1
+        COUNT["Mongo insertions"] += details['nUpserted']
+        COUNT["Mongo upserts"] += details['nMatched']
+        record_stage('mongo', seconds)
+
+
+def flush_mongo(wait_for_writes=True):
+    ''' Hand pending publishedURL upserts to a Mongo writer thread. At most
+        --mongo-writers bulk writes are in flight, so this blocks when MongoDB falls
+        behind.
+        Keyword arguments:
+          wait_for_writes: wait for all bulk writes to complete
+        Returns:
+          None
+    '''
+    if UPSERTS:
+        if not MONGO_WRITE['executor']:
+            MONGO_WRITE['executor'] = ThreadPoolExecutor(max_workers=ARG.MONGO_WRITERS,
+                                                         thread_name_prefix='mongo')
+        while len(MONGO_WRITE['pending']) >= ARG.MONGO_WRITERS:
+            finish_mongo(FIRST_COMPLETED)
+        batch = UPSERTS[:]
+        UPSERTS.clear()
+        MONGO_WRITE['pending'][MONGO_WRITE['executor'].submit(write_upserts, batch)] = batch
+    if wait_for_writes:
+        finish_mongo()
+
+
+def shutdown_mongo():
+    ''' Write the remaining publishedURL upserts and stop the Mongo writers
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    flush_mongo()
+    if MONGO_WRITE['executor']:
+        MONGO_WRITE['executor'].shutdown()
+        MONGO_WRITE['executor'] = None
 
 
 def add_image_to_mongo(smp):
-    ''' Add an image to the publishedURL collection
+    ''' Add an image to the publishedURL collection. Upserts are buffered and written
+        in batches of --mongo-batch documents (or written to the plan file).
         Keyword arguments:
           smp: sample record
         Returns:
           None
     '''
-    coll = DBM['neuronbridge'].publishedURL
     payload = {}
     for col in CLOAD.published_col:
         if col in smp:
@@ -1110,15 +2356,23 @@ def add_image_to_mongo(smp):
         payload['alpsRelease'] = smp['alpsRelease']
     if "DATASET" in CONF:
         payload['publishedName'] = ":".join([CONF['DATASET'], payload['publishedName']])
+    if ARG.PLAN:
+        write_plan(['', '', '', 0, '', 0, json.dumps(payload, default=str)])
+        return
+    queue_upsert(payload)
+
+
+def queue_upsert(payload):
+    ''' Buffer a publishedURL upsert, writing the buffer when it is full
+        Keyword arguments:
+          payload: publishedURL document
+        Returns:
+          None
+    '''
     payload["updateDate"] = datetime.now()
-    try:
-        result = coll.update_one({"_id": payload['_id']}, {"$set": payload}, upsert=True)
-    except Exception:
-        LOGGER.error("Could not insert %s into Mongo", smp['_id'])
-    if hasattr(result, 'inserted_id') and result.inserted_id == smp['_id']:
-        COUNT["Mongo insertions"] += 1
-    else:
-        COUNT["Mongo upserts"] += 1
+    UPSERTS.append(payload)
+    if len(UPSERTS) >= ARG.MONGO_BATCH:
+        flush_mongo(False)
 
 
 def remap_sample(smp):
@@ -1147,36 +2401,814 @@ def remap_sample(smp):
         smp['variants']['gradient'] = smp['computeFiles']['GradientImage']
 
 
-def write_output_files(json_out, names_out):
-    ''' Produce output files
+def set_output_files():
+    ''' Set the output file names for the library (and shard)
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    # pylint: disable=W0603
+    global ERR_FILE, S3CP_FILE, NAMES_FILE, JSONO_FILE, KEY_FILE, JOURNAL_FILE, VALIDATE_FILE, \
+           COUNTS_FILE
+    base = ARG.LIBRARY
+    if 'SHARD' in CONF:
+        base += f"_shard{CONF['SHARD'][0]}of{CONF['SHARD'][1]}"
+    ERR_FILE = f"{base}_errors_{STAMP}.txt"
+    S3CP_FILE = f"{base}_s3cp_{STAMP}.txt"
+    NAMES_FILE = f"{base}_{STAMP}.names"
+    if ARG.RELEASE:
+        JSONO_FILE = f"{base}_{ARG.RELEASE}_{STAMP}.ndjson"
+    else:
+        JSONO_FILE = f"{base}_{STAMP}.ndjson"
+    KEY_FILE = f"{base}_keys_{STAMP}.txt"
+    VALIDATE_FILE = f"{base}_validation_{STAMP}.txt"
+    COUNTS_FILE = f"{base}_counts_{STAMP}.json"
+    JOURNAL_FILE = ARG.JOURNAL if ARG.JOURNAL else f"{base}_{ARG.ALIGNMENT}_journal.jsonl"
+
+
+def output_path(fpath):
+    ''' Return the path an output file is written to (with a .gz suffix if it's
+        compressed)
+        Keyword arguments:
+          fpath: file path (without the .gz suffix)
+        Returns:
+          File path
+    '''
+    return fpath + '.gz' if ARG.COMPRESS else fpath
+
+
+def open_output(fpath):
+    ''' Open an output stream, compressing it if requested
+        Keyword arguments:
+          fpath: file path (without the .gz suffix)
+        Returns:
+          Output stream
+    '''
+    if ARG.COMPRESS:
+        return gzip.open(output_path(fpath), 'wt', encoding='ascii')
+    return open(fpath, 'w', encoding='ascii')
+
+
+def open_packing():
+    ''' Load the subdivision packing file (if it exists) and open it to record new
+        assignments
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not ARG.PACKING:
+        return
+    if os.path.exists(ARG.PACKING):
+        with open(ARG.PACKING, 'r', encoding='ascii') as instream:
+            for line in instream:
+                ancname, prefix, _ = line.rstrip("\n").split("\t")
+                PACKING[ancname] = int(prefix)
+        LOGGER.info(f"Loaded {len(PACKING):,} subdivision assignments from {ARG.PACKING}")
+    OUTPUT['packing'] = open(ARG.PACKING, 'a', encoding='ascii')
+
+
+def open_output_files():
+    ''' Open the JSON and names output streams
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    OUTPUT['json'] = open_output(JSONO_FILE)
+    OUTPUT['names'] = open(NAMES_FILE, 'w', encoding='ascii')
+
+
+def write_sample(smp):
+    ''' Write a processed sample to the JSON output as a single line
+        Keyword arguments:
+          smp: sample record
+        Returns:
+          None
+    '''
+    line = json.dumps(smp, default=str) + "\n"
+    OUTPUT['json'].write(line)
+    if JOURNAL['stream']:
+        JOURNAL['json'].append(line)
+
+
+def write_order(line):
+    ''' Write a line to the order (s3cp) file
+        Keyword arguments:
+          line: source filepath and bucket/object name
+        Returns:
+          None
+    '''
+    S3CP.write(line)
+    if JOURNAL['stream']:
+        JOURNAL['s3cp'].append(line)
+
+
+def write_name(pname):
+    ''' Write a publishing name to the names output
+        Keyword arguments:
+          pname: publishing name
+        Returns:
+          None
+    '''
+    OUTPUT['names'].write(f"{pname}\n")
+
+
+def write_key(object_name):
+    ''' Write a searchable_neurons key to the key file. The file is a JSON list with
+        one key per line, and is opened when the first key is written.
+        Keyword arguments:
+          object_name: S3 object name
+        Returns:
+          None
+    '''
+    if OUTPUT['keys']:
+        OUTPUT['keys'].write(",\n")
+    else:
+        LOGGER.info("Writing key file")
+        OUTPUT['keys'] = open_output(KEY_FILE)
+        OUTPUT['keys'].write("[\n")
+    OUTPUT['keys'].write(json.dumps(object_name))
+
+
+def flush_output_files():
+    ''' Flush the output streams so that partial progress is on disk
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    for stream in [ERR, S3CP] + list(OUTPUT.values()):
+        if stream:
+            stream.flush()
+
+
+def close_output_files():
+    ''' Close the output streams
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if OUTPUT['keys']:
+        OUTPUT['keys'].write("\n]\n")
+    for key, stream in OUTPUT.items():
+        if stream:
+            stream.close()
+            OUTPUT[key] = None
+
+
+def read_output(fpath):
+    ''' Open an output file for reading, decompressing it if needed
+        Keyword arguments:
+          fpath: file path
+        Returns:
+          Input stream
+    '''
+    if fpath.endswith('.gz'):
+        return gzip.open(fpath, 'rt', encoding='ascii')
+    return open(fpath, 'r', encoding='ascii')
+
+
+def find_shard_files(kind):
+    ''' Find the most recent output file of one kind for each shard of the library
+        Keyword arguments:
+          kind: output file kind (key in SHARD_OUTPUT)
+        Returns:
+          List of file paths (in shard order) and set of shard counts
+    '''
+    latest = {}
+    totals = set()
+    for fpath in sorted(glob.glob(f"{ARG.LIBRARY}_shard*of*{SHARD_OUTPUT[kind]}")):
+        field = re.search(r"_shard(\d+)of(\d+)_", fpath)
+        if not field:
+            continue
+        shard = int(field[1])
+        totals.add(int(field[2]))
+        if shard in latest:
+            LOGGER.warning(f"Using {fpath} instead of {latest[shard]}")
+        latest[shard] = fpath
+    if latest and totals and len(latest) < max(totals):
+        missing = sorted(set(range(max(totals))) - set(latest))
+        LOGGER.warning(f"No {kind} file for shards {', '.join(str(shd) for shd in missing)}")
+    return [latest[shard] for shard in sorted(latest)], totals
+
+
+def merge_shards():
+    ''' Merge the output files from a sharded run into the files a single run would
+        have produced
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    shards = {}
+    totals = set()
+    for kind in SHARD_OUTPUT:
+        shards[kind], found = find_shard_files(kind)
+        totals.update(found)
+    if not totals:
+        terminate_program(f"No shard output files found for {ARG.LIBRARY}")
+    if len(totals) > 1:
+        terminate_program(f"Shard output files are from runs with different shard counts " \
+                          + f"({', '.join(str(tot) for tot in sorted(totals))})")
+    open_output_files()
+    names = {}
+    incomplete = []
+    counts = shards.pop('counts')
+    for kind, files in shards.items():
+        for fpath in files:
+            LOGGER.info(f"Merging {fpath}")
+            try:
+                complete = merge_shard_file(kind, fpath, names)
+            except (EOFError, OSError) as err:
+                # A compressed file from a shard that crashed has no gzip trailer
+                LOGGER.warning(f"Could not read all of {fpath}: {err}")
+                complete = False
+            if not complete:
+                incomplete.append(fpath)
+    print(f"Merged {max(totals)} shards into {output_path(JSONO_FILE)}")
+    if incomplete:
+        LOGGER.error("Incomplete shard output files (the shards may not have finished): "
+                     + ", ".join(incomplete))
+    merge_shard_counts(counts, max(totals))
+
+
+def merge_shard_counts(files, total):
+    ''' Combine the image and sample counts from the shards, and update the library
+        status with them (with --write or --config)
+        Keyword arguments:
+          files: shard count files
+          total: number of shards
+        Returns:
+          None
+    '''
+    update = ARG.WRITE or ARG.CONFIG
+    if len(files) < total:
+        if update:
+            LOGGER.error("Not every shard has finished, so the library status wasn't updated")
+        return
+    for fpath in files:
+        try:
+            with open(fpath, 'r', encoding='ascii') as instream:
+                counts = json.load(instream)
+        except Exception as err:
+            LOGGER.error(f"Could not read {fpath}, so the library status wasn't updated: {err}")
+            return
+        COUNT['Images processed'] += counts['images']
+        COUNT['Samples'] += counts['samples']
+    print(f"Images processed: {COUNT['Images processed']:,}")
+    print(f"Samples:          {COUNT['Samples']:,}")
+    if update:
+        # The library status uses the shards' parameters
+        for key in ('manifold', 'dataset', 'neuprint', 'release', 'tag'):
+            setattr(ARG, key.upper(), counts[key])
+        connect_neuronbridge()
+        update_library_config()
+
+
+def write_shard_counts():
+    ''' Write this shard's image and sample counts, which are combined by --merge
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    counts = {"manifold": ARG.MANIFOLD, "dataset": ARG.DATASET, "neuprint": ARG.NEUPRINT,
+              "release": ARG.RELEASE, "tag": ARG.TAG, "images": COUNT['Images processed'],
+              "samples": COUNT['Samples']}
+    with open(COUNTS_FILE, 'w', encoding='ascii') as outstream:
+        json.dump(counts, outstream)
+
+
+def merge_shard_file(kind, fpath, names):
+    ''' Merge one shard output file. Files are read a line at a time, so that the
+        output from a shard that crashed is merged up to its last complete line.
+        Keyword arguments:
+          kind: output file kind (key in SHARD_OUTPUT)
+          fpath: file path
+          names: dictionary of publishing names merged so far
+        Returns:
+          True if the file is complete
+    '''
+    with read_output(fpath) as instream:
+        for line in instream:
+            if kind == 'keys':
+                # The key file is a JSON list with one key per line
+                key = line.strip().rstrip(',')
+                if key == ']':
+                    return True
+                if key in ('[', ''):
+                    continue
+                try:
+                    write_key(json.loads(key))
+                except json.JSONDecodeError:
+                    LOGGER.warning(f"Skipping partial last key in {fpath}")
+                    return False
+            elif not line.endswith("\n"):
+                LOGGER.warning(f"Skipping partial last line of {fpath}")
+                return False
+            elif kind == 'errors':
+                ERR.write(line)
+            elif kind == 's3cp':
+                S3CP.write(line)
+            elif kind == 'json':
+                OUTPUT['json'].write(line)
+            elif line.strip() not in names:
+                names[line.strip()] = True
+                write_name(line.strip())
+    # Only the key file has an end marker
+    return kind != 'keys'
+
+
+def open_plan():
+    ''' Open the plan file and write its header. The first line is a JSON comment
+        describing the run, and the second names the columns.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not ARG.PLAN:
+        return
+    meta = {"library": ARG.LIBRARY, "alignment": ARG.ALIGNMENT, "manifold": ARG.MANIFOLD,
+            "tag": ARG.TAG, "release": ARG.RELEASE, "dataset": ARG.DATASET,
+            "neuprint": ARG.NEUPRINT, "shard": CONF.get('SHARD'), "thumbnails": ARG.THUMBNAILS,
+            "thumbnail_width": ARG.THUMBNAIL_WIDTH, "thumbnail_quality": ARG.THUMBNAIL_QUALITY,
+            "version": __version__}
+    PLAN['stream'] = gzip.open(ARG.PLAN, 'wt', encoding='ascii')
+    PLAN['stream'].write(f"# {json.dumps(meta)}\n")
+    PLAN['stream'].write("\t".join(PLAN_COLUMNS) + "\n")
+
+
+def write_plan(row):
+    ''' Write a row (an upload or a MongoDB document) to the plan file
+        Keyword arguments:
+          row: list of values in PLAN_COLUMNS order
+        Returns:
+          None
+    '''
+    PLAN['stream'].write("\t".join(str(col) for col in row) + "\n")
+    if row[6]:
+        PLAN['documents'] += 1
+    else:
+        PLAN['objects'] += 1
+        PLAN['bytes'] += row[3]
+
+
+def close_plan():
+    ''' Close the plan file and report what it will transfer
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not PLAN['stream']:
+        return
+    PLAN['stream'].close()
+    PLAN['stream'] = None
+    print(f"Plan {ARG.PLAN}: {PLAN['objects']:,} objects " \
+          + f"({PLAN['bytes'] / 1024 ** 3:,.2f}GB before PNG conversion), " \
+          + f"{PLAN['documents']:,} MongoDB documents")
+
+
+def read_plan_header():
+    ''' Read the run description from a plan file and apply it to the arguments
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    try:
+        with gzip.open(ARG.EXECUTE, 'rt', encoding='ascii') as instream:
+            line = instream.readline()
+            meta = json.loads(line[2:])
+            columns = instream.readline().rstrip("\n").split("\t")
+    except Exception as err:
+        terminate_program(f"Could not read plan {ARG.EXECUTE}: {err}")
+    if columns != PLAN_COLUMNS:
+        terminate_program(f"{ARG.EXECUTE} has unexpected columns {', '.join(columns)}")
+    if meta['version'] != __version__:
+        LOGGER.warning(f"{ARG.EXECUTE} was written by version {meta['version']}")
+    ARG.LIBRARY = meta['library']
+    ARG.ALIGNMENT = meta['alignment']
+    ARG.TAG = meta['tag']
+    ARG.RELEASE = meta['release']
+    ARG.DATASET = meta['dataset']
+    ARG.NEUPRINT = meta['neuprint']
+    ARG.THUMBNAILS = meta.get('thumbnails', False)
+    ARG.THUMBNAIL_WIDTH = meta.get('thumbnail_width', THUMBNAIL_WIDTH)
+    ARG.THUMBNAIL_QUALITY = meta.get('thumbnail_quality', THUMBNAIL_QUALITY)
+    if ARG.MANIFOLD and ARG.MANIFOLD != meta['manifold']:
+        terminate_program(f"{ARG.EXECUTE} was planned for the {meta['manifold']} manifold")
+    ARG.MANIFOLD = meta['manifold']
+    if meta['shard']:
+        CONF['SHARD'] = tuple(meta['shard'])
+
+
+def initialize_execute():
+    ''' Initialize for running a plan. Only the connections needed to carry out the
+        plan are opened.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    read_plan_header()
+    # The library status is written with --write or --config
+    if ARG.WRITE or ARG.CONFIG:
+        connect_neuronbridge()
+    if ARG.AWS:
+        initialize_s3()
+
+
+def connect_neuronbridge():
+    ''' Authenticate, and connect to the NeuronBridge database for writing
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    check_tokens(['JACS_JWT'])
+    try:
+        dbconfig = JRC.get_config("databases")
+        dbo = attrgetter(f"neuronbridge.{ARG.MONGO}.write")(dbconfig)
+        LOGGER.info("Connecting to %s %s on %s as %s", dbo.name, ARG.MANIFOLD, dbo.host,
+                    dbo.user)
+        DBM['neuronbridge'] = JRC.connect_database(dbo)
+    except Exception as err:
+        terminate_program(err)
+
+
+def read_plan():
+    ''' Yield the rows of a plan file
+        Keyword arguments:
+          None
+        Returns:
+          Generator of row dictionaries
+    '''
+    with gzip.open(ARG.EXECUTE, 'rt', encoding='ascii') as instream:
+        instream.readline()
+        instream.readline()
+        for line in instream:
+            yield dict(zip(PLAN_COLUMNS, line.rstrip("\n").split("\t")))
+
+
+def plan_candidate(row):
+    ''' Return the source path and PNG name for a plan row that will be converted,
+        or None if it won't be
+        Keyword arguments:
+          row: plan row
+        Returns:
+          Source filepath and new file name (None for a thumbnail only), or None
+    '''
+    if (not ARG.AWS) or row['convert'] != '1':
+        return None
+    if unchanged(row['source'], row['bucket'], row['key']):
+        return None
+    if row['mimetype'] == 'image/jpeg':
+        return (row['source'], None) if ARG.THUMBNAILS else None
+    return row['source'], os.path.basename(row['key'])
+
+
+def execute_plan():
+    ''' Carry out the uploads and MongoDB writes in a plan file. Files are only
+        uploaded with --aws, and MongoDB is only updated with --write. A sample's
+        uploads precede its document in the plan, so the document is held until they
+        have completed.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    print(f"Executing {ARG.EXECUTE} for {ARG.LIBRARY} on {ARG.MANIFOLD} manifold")
+    if ARG.VALIDATE:
+        images = {}
+        for row in read_plan():
+            if row['source'].endswith(('.png', '.tif', '.tiff')) \
+               and row['mimetype'] != 'image/jpeg':
+                parts = row['key'].split('/')
+                images[row['source']] = parts[2] if len(parts) > 3 else 'cdm'
+        validate_images(images)
+    open_digest_cache()
+    for row in tqdm(lookahead(read_plan(), plan_candidate)):
+        write_metrics()
+        if row['document']:
+            COUNT['Samples'] += 1
+            if UPLOAD['sample'] is None:
+                hold_sample(None)
+            UPLOAD['sample']['document'] = json.loads(row['document'])
+            release_sample()
+            continue
+        PLAN['objects'] += 1
+        PLAN['bytes'] += int(row['size'])
+        COUNT['Images processed'] += 1
+        if not ARG.AWS:
+            continue
+        if UPLOAD['sample'] is None:
+            hold_sample(None)
+        if unchanged(row['source'], row['bucket'], row['key']):
+            COUNT['Unchanged objects'] += 1
+            continue
+        fpath = row['source']
+        cleanup = None
+        if row['convert'] == '1':
+            fpath = cleanup = CLOAD.temp_dir + os.path.basename(row['key'])
+            CONVERT['source'][fpath] = row['source']
+            if row['mimetype'] == 'image/jpeg':
+                BUFFERED[fpath] = take_thumbnail(row['source'])
+            else:
+                collect_conversion(row['source'], fpath)
+        submit_upload(fpath, row['bucket'], row['key'], upload_payload(row['mimetype']),
+                      cleanup)
+    release_sample(False)
+    shutdown_uploads()
+    shutdown_mongo()
+    shutdown_conversions()
+    close_digest_cache()
+    write_metrics(True)
+    print(f"Plan {ARG.EXECUTE}: {PLAN['objects']:,} objects " \
+          + f"({PLAN['bytes'] / 1024 ** 3:,.2f}GB before PNG conversion), " \
+          + f"{COUNT['Samples']:,} MongoDB documents")
+
+
+def restore_journal():
+    ''' Restore counters, subdivision, and upload state from the checkpoint journal.
+        The JSON output and order file lines of committed samples are written to this
+        run's output files, so that they are complete.
+        Keyword arguments:
+          None
+        Returns:
+          Dictionary of publishing names from committed samples
+    '''
+    if not os.path.exists(JOURNAL_FILE):
+        terminate_program(f"Journal {JOURNAL_FILE} does not exist")
+    names = {}
+    last = None
+    offset = 0
+    with open(JOURNAL_FILE, 'rb') as instream:
+        for line in instream:
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash during a checkpoint can leave a partial record at the end
+                LOGGER.warning(f"Discarding incomplete journal record at offset {offset:,}")
+                break
+            offset += len(line)
+            JOURNAL['committed'].update(rec['samples'])
+            for object_name, source in rec['keys']:
+                record_upload(object_name, source)
+                if "/searchable_neurons/" in object_name:
+                    write_key(object_name)
+            names.update(dict.fromkeys(rec['names'], True))
+            for out in rec.get('json', []):
+                OUTPUT['json'].write(out)
+            for out in rec.get('s3cp', []):
+                S3CP.write(out)
+            last = rec
+    os.truncate(JOURNAL_FILE, offset)
+    if last:
+        COUNT.update(last['count'])
+        VARIANT_UPLOADS.update(last['variants'])
+        RELPUB.update(last['relpub'])
+        SUBDIVISION.update(last['subdivision'])
+    LOGGER.warning(f"Resuming after {len(JOURNAL['committed']):,} committed samples " \
+                   + f"({len(UPLOADED['names']):,} objects) from {JOURNAL_FILE}")
+    LOGGER.warning("Will upload searchable neurons starting with subdivision %s",
+                   SUBDIVISION['prefix'])
+    return names
+
+
+def open_journal():
+    ''' Open the checkpoint journal. The journal is only kept for runs that upload
+        files or update MongoDB.
+        Keyword arguments:
+          None
+        Returns:
+          Dictionary of publishing names restored from the journal
+    '''
+    names = {}
+    if not (ARG.WRITE or ARG.AWS):
+        return names
+    if ARG.RESUME and ARG.BATCH and not os.path.exists(JOURNAL_FILE):
+        # Libraries in a batch that finished (or never started) have no journal
+        LOGGER.warning(f"No journal for {ARG.LIBRARY} - starting from the beginning")
+    elif ARG.RESUME:
+        names = restore_journal()
+    elif os.path.exists(JOURNAL_FILE):
+        terminate_program(f"Journal {JOURNAL_FILE} exists - use --resume or remove it")
+    JOURNAL['stream'] = open(JOURNAL_FILE, 'a', encoding='ascii')
+    return names
+
+
+def checkpoint(force=False):
+    ''' Append the samples processed since the last checkpoint to the journal. Pending
+        uploads and MongoDB writes are completed first, so journaled samples are durable.
+        Keyword arguments:
+          force: write the checkpoint regardless of how many samples are pending
+        Returns:
+          None
+    '''
+    if not JOURNAL['stream'] or not JOURNAL['samples']:
+        return
+    if len(JOURNAL['samples']) < ARG.MONGO_BATCH and not force:
+        return
+    finish_uploads()
+    flush_mongo()
+    if DIGEST['db'] is not None:
+        DIGEST['db'].sync()
+    rec = {"samples": JOURNAL['samples'], "keys": JOURNAL['keys'], "names": JOURNAL['names'],
+           "json": JOURNAL['json'], "s3cp": JOURNAL['s3cp'], "count": COUNT,
+           "variants": VARIANT_UPLOADS, "relpub": RELPUB, "subdivision": SUBDIVISION}
+    JOURNAL['stream'].write(json.dumps(rec) + "\n")
+    JOURNAL['stream'].flush()
+    os.fsync(JOURNAL['stream'].fileno())
+    for key in ('samples', 'keys', 'names', 'json', 's3cp'):
+        JOURNAL[key] = []
+    flush_output_files()
+
+
+def close_journal():
+    ''' Close and remove the checkpoint journal after a completed run
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if not JOURNAL['stream']:
+        return
+    JOURNAL['stream'].close()
+    JOURNAL['stream'] = None
+    os.remove(JOURNAL_FILE)
+
+
+def open_digest_cache():
+    ''' Open the digest cache of previously uploaded files
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    DIGEST['md5'].clear()
+    if not ARG.DIGEST_CACHE:
+        return
+    try:
+        DIGEST['db'] = shelve.open(ARG.DIGEST_CACHE)
+    except Exception as err:
+        terminate_program(err)
+    LOGGER.info(f"Opened digest cache {ARG.DIGEST_CACHE} ({len(DIGEST['db']):,} entries)")
+
+
+def close_digest_cache():
+    ''' Close the digest cache
         Keyword arguments:
-          json_out: JSON output
-          names_out: names to output
+          None
         Returns:
           None
     '''
-    if json_out:
-        LOGGER.info("Writing JSON file")
-    with open(JSONO_FILE, 'w', encoding='ascii') as jsonfile:
-        jsonfile.write(json.dumps(json_out, indent=4, default=str))
-    if names_out:
-        LOGGER.info("Writing names file")
-        with open(NAMES_FILE, 'w', encoding='ascii') as namefile:
-            for pname in names_out:
-                namefile.write(f"{pname}\n")
+    DIGEST['md5'].clear()
+    if DIGEST['db'] is not None:
+        DIGEST['db'].close()
+        DIGEST['db'] = None
+
+
+def image_header(fpath):
+    ''' Read an image header (but no pixel data). For TIFFs, the strip (or tile) offsets
+        and byte counts are checked against the file size to detect truncated files.
+        This runs in a validation worker thread.
+        Keyword arguments:
+          fpath: image file path
+        Returns:
+          Dictionary of header information, with an error message if the image is bad
+    '''
+    info = {"path": fpath}
+    try:
+        info['bytes'] = os.path.getsize(fpath)
+        with Image.open(fpath) as image:
+            info['header'] = f"{image.format} {image.width}x{image.height} {image.mode}"
+            if image.format == 'TIFF':
+                offsets = image.tag_v2.get(273, image.tag_v2.get(324))
+                counts = image.tag_v2.get(279, image.tag_v2.get(325))
+                if isinstance(offsets, int):
+                    offsets, counts = (offsets,), (counts,)
+                if offsets and counts:
+                    end = max(off + cnt for off, cnt in zip(offsets, counts))
+                    if end > info['bytes']:
+                        info['error'] = f"Truncated: image data ends at byte {end:,} " \
+                                        + f"but file is {info['bytes']:,} bytes"
+    except Exception as err:
+        info['error'] = str(err)
+    return info
+
+
+def validate_images(images):
+    ''' Check the headers of source images in parallel. Images that can't be read, are
+        truncated, or whose format/dimensions/mode differ from the most common for their
+        kind are written to a report, and the program terminates if there are any.
+        Keyword arguments:
+          images: dictionary of image kind keyed by file path
+        Returns:
+          None
+    '''
+    stime = datetime.now()
+    print(f"Validating {len(images):,} images")
+    headers = collections.defaultdict(collections.Counter)
+    bad = []
+    with ThreadPoolExecutor(max_workers=ARG.WORKERS * 4,
+                            thread_name_prefix='validate') as executor:
+        results = list(tqdm(executor.map(image_header, images), total=len(images)))
+    for info in results:
+        if 'error' in info:
+            bad.append(f"{info['path']}\t{info['error']}")
+        else:
+            headers[images[info['path']]][info['header']] += 1
+    expected = {kind: count.most_common(1)[0][0] for kind, count in headers.items()}
+    for info in results:
+        if 'error' not in info and info['header'] != expected[images[info['path']]]:
+            bad.append(f"{info['path']}\t{images[info['path']]} is {info['header']}, " \
+                       + f"expected {expected[images[info['path']]]}")
+    time_diff = datetime.now() - stime
+    LOGGER.info(f"Validated {len(images):,} images in {time_diff.total_seconds():f}sec")
+    for kind in sorted(headers):
+        print(f"  {kind + ':' : <23} {expected[kind]} " \
+              + f"({headers[kind][expected[kind]]:,}/{sum(headers[kind].values()):,})")
+    if not bad:
+        return
+    with open(VALIDATE_FILE, 'w', encoding='ascii') as outstream:
+        outstream.write("\n".join(bad) + "\n")
+    terminate_program(f"{len(bad):,} images failed validation - see {VALIDATE_FILE}")
+
+
+def validate_sources():
+    ''' Validate the source images for the library's samples before processing them
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    images = {}
+    _, cursor = read_json(['computeFiles'])
+    for smp in cursor:
+        for kind in VALIDATE_FILES:
+            if kind in smp.get('computeFiles', {}):
+                images[smp['computeFiles'][kind]] = kind
+    cursor.close()
+    validate_images(images)
+
+
+def get_published_ids():
+    ''' Load the IDs that are already in publishedURL. Like the per-sample check this
+        replaced, any library's document with a sample's ID counts, so only the _id
+        index is needed.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    if ARG.REWRITE:
+        return
+    stime = datetime.now()
+    coll = DBM['neuronbridge'].publishedURL
+    payload = {}
+    if 'SHARD' in CONF:
+        payload['_id'] = {"$mod": [CONF['SHARD'][1], CONF['SHARD'][0]]}
+    try:
+        for row in coll.find(payload, {"_id": 1}, batch_size=10000):
+            PUBLISHED_ID.add(row['_id'])
+    except Exception as err:
+        terminate_program(err)
+    size = sys.getsizeof(PUBLISHED_ID) + sum(sys.getsizeof(pid) for pid in PUBLISHED_ID)
+    time_diff = datetime.now() - stime
+    LOGGER.info(f"Found {len(PUBLISHED_ID):,} IDs in publishedURL in " \
+                + f"{time_diff.total_seconds():f}sec ({size / 1024 ** 2:,.1f}MB)")
 
 
 def get_published_samples():
-    ''' Build a dictionary of published samples from publishedLMImage
+    ''' Build a dictionary of published samples from publishedLMImage. The sample
+        references are streamed from a $group aggregation (sorted on sampleRef so that
+        it can be answered from the index) rather than returned by distinct, which is
+        limited to a single 16MB document.
         Keyword arguments:
           None
         Returns:
           Dictionary of published samples
     '''
+    stime = datetime.now()
     coll = DBM['neuronbridge'].publishedLMImage
-    rows = coll.distinct("sampleRef")
-    LOGGER.info(f"Found {len(rows):,} published sample IDs")
-    return dict.fromkeys(rows, True)
+    pipeline = [{"$match": {"sampleRef": {"$type": "string"}}},
+                {"$sort": {"sampleRef": 1}},
+                {"$group": {"_id": "$sampleRef"}}]
+    published = {}
+    try:
+        for row in coll.aggregate(pipeline, allowDiskUse=True, batchSize=10000):
+            published[row['_id']] = True
+    except Exception as err:
+        terminate_program(err)
+    time_diff = datetime.now() - stime
+    LOGGER.info(f"Found {len(published):,} published sample IDs in " \
+                + f"{time_diff.total_seconds():f}sec")
+    return published
 
 
 def upload_cdms():
@@ -1187,11 +3219,16 @@ def upload_cdms():
         Returns:
           None
     '''
-    data = read_json()
-    entries = len(data)
+    entries, cursor = read_json()
+    READER['cursor'] = cursor
     print(f"Number of entries in JSON: {entries:,}")
     if not entries:
+        if ARG.BATCH:
+            LOGGER.error(f"No entries to process for {ARG.LIBRARY}")
+            close_reader()
+            return
         terminate_program("No entries to process")
+    start = perf_counter()
     if ARG.LIBRARY.startswith('flyem') or ARG.LIBRARY.startswith('flywire'):
         get_flyem_dataset()
     else:
@@ -1200,15 +3237,28 @@ def upload_cdms():
         publishing_db = 'gen1mcfo' if 'gen1_mcfo' in ARG.LIBRARY else 'mbew'
         if 'raw' in ARG.LIBRARY:
             publishing_db = 'raw'
-        (CONN[publishing_db], CURSOR[publishing_db]) = db_connect(dbdata[publishing_db][ARG.MYSQL])
+        if publishing_db not in CONN:
+            (CONN[publishing_db], CURSOR[publishing_db]) = \
+                db_connect(dbdata[publishing_db][ARG.MYSQL])
         print("Getting image mapping")
-        get_line_mapping(publishing_db)
-        get_image_mapping(publishing_db)
+        load_mappings(publishing_db)
         if ARG.BACKCHECK:
-            backcheck(data)
+            backcheck(cursor)
         # Get published samples
-        published_sample = get_published_samples()
-    set_searchable_subdivision(data[0])
+        if 'publishedLMImage' not in MAPPING:
+            MAPPING['publishedLMImage'] = get_published_samples()
+        published_sample = MAPPING['publishedLMImage']
+    get_published_ids()
+    record_stage('mapping', perf_counter() - start)
+    first = next(cursor, None)
+    if not first:
+        if ARG.BATCH:
+            LOGGER.error(f"No entries to process for {ARG.LIBRARY}")
+            close_reader()
+            return
+        terminate_program("No entries to process")
+    data = prefetch(chain([first], cursor), 'read_json')
+    set_searchable_subdivision(first)
     # Manifest
     added = tried = 0
     if ARG.MANIFEST:
@@ -1220,41 +3270,158 @@ def upload_cdms():
                     MANIFEST[row] = True
                     added += 1
         LOGGER.info(f"Added {added:,}/{tried:,} entries from manifest")
+    if ARG.VALIDATE:
+        validate_sources()
     if not confirm_run():
+        close_reader()
         return
     print(f"Processing {ARG.LIBRARY} on {ARG.MANIFOLD} manifold")
-    json_out = []
-    names_out = {}
-    for smp in tqdm(data):
+    open_output_files()
+    open_plan()
+    open_packing()
+    open_name_store()
+    names_out = open_journal()
+    for pname in names_out:
+        write_name(pname)
+    open_digest_cache()
+    for smp in tqdm(lookahead(data), total=entries):
+        if smp['_id'] in JOURNAL['committed']:
+            continue
+        if ARG.SAMPLES and COUNT['Samples'] >= ARG.SAMPLES:
+            break
+        checkpoint()
+        if JOURNAL['stream']:
+            JOURNAL['samples'].append(smp['_id'])
         if 'flylight' in ARG.LIBRARY and smp['slideCode'] in NON_PUBLIC:
             COUNT['Sample not published'] += 1
             LOGGER.warning("Sample %s is in non-public release %s", smp['sourceRefId'],
                            NON_PUBLIC[smp['slideCode']])
+            discard_thumbnail(smp)
             continue
         if 'flylight' in ARG.LIBRARY and smp['sourceRefId'] not in published_sample:
             COUNT['Sample not published'] += 1
             LOGGER.warning("Sample %s is not published in publishedLMImage", smp['sourceRefId'])
         remap_sample(smp)
-        if ARG.SAMPLES and COUNT['Samples'] >= ARG.SAMPLES:
-            break
         COUNT['Samples'] += 1
-        if not check_image(smp):
+        write_metrics()
+        start = perf_counter()
+        checked = check_image(smp)
+        record_stage('check_image', perf_counter() - start)
+        if not checked:
+            discard_thumbnail(smp)
             continue
         REC['alignment_space'] = smp['alignmentSpace']
+        # The sample is written once its uploads have completed
+        hold_sample(smp)
         # Primary image
         newname = handle_primary(smp)
         if newname:
             # Publishing name
-            names_out[smp['publishedName']] = True
+            if smp['publishedName'] not in names_out:
+                names_out[smp['publishedName']] = True
+                write_name(smp['publishedName'])
+                if JOURNAL['stream']:
+                    JOURNAL['names'].append(smp['publishedName'])
             # Variants
             handle_variants(smp, newname)
             for product in REQUIRED_PRODUCTS:
                 if product not in smp['uploaded']:
                     LOGGER.error(f"Missing {product} for ID {smp['_id']}")
-            json_out.append(smp)
-            if ARG.WRITE:
-                add_image_to_mongo(smp)
-    write_output_files(json_out, names_out)
+        release_sample(bool(newname))
+        if not newname:
+            discard_thumbnail(smp)
+    data.close()
+    close_reader()
+    checkpoint(True)
+    shutdown_uploads()
+    shutdown_mongo()
+    shutdown_conversions()
+    close_digest_cache()
+    close_name_store()
+    close_output_files()
+    close_plan()
+    close_journal()
+    write_metrics(True)
+
+
+def reset_library():
+    ''' Reset the per-library state between the libraries in a batch
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    for store in (BUFFERED, COUNT, MANIFEST, NO_RELEASE, PACKING, PNAME, PUBLISHED_ID, RELPUB,
+                  STAGE, VARIANT_UPLOADS, WORKER):
+        store.clear()
+    METRICS['start'] = perf_counter()
+    for key in UPLOADED:
+        UPLOADED[key].clear()
+    for key in ('done', 'source'):
+        CONVERT[key].clear()
+    JOURNAL.update({'committed': set(), 'samples': [], 'keys': [], 'names': [], 'json': [],
+                    's3cp': []})
+    SUBDIVISION.update({'prefix': 1, 'counter': 0, 'stride': 1, 'bytes': 0})
+    REQUIRED_PRODUCTS[:] = ['cdm', 'cdm_thumbnail']
+    CONF.pop('DATASET', None)
+
+
+def run_batch():
+    ''' Process each library in the batch file. The configuration, database and S3
+        connections, and mapping tables are shared by all of the libraries, and the
+        run isn't confirmed.
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    global ERR, S3CP # pylint: disable=W0603
+    for library, alignment, tag, variants in CONF['BATCH']:
+        reset_library()
+        ARG.LIBRARY, ARG.ALIGNMENT, ARG.TAG = library, alignment, tag
+        select_uploads(variants)
+        set_output_files()
+        ERR = open(ERR_FILE, 'w', encoding='ascii')
+        S3CP = open(S3CP_FILE, 'w', encoding='ascii')
+        start_time = datetime.now()
+        upload_cdms()
+        if CONF.get('CONFIRMED') is False:
+            close_run_files()
+            break
+        update_library_config()
+        print_summary(datetime.now() - start_time)
+        close_run_files()
+
+
+def print_summary(elapsed):
+    ''' Print the counts for a library
+        Keyword arguments:
+          elapsed: elapsed time
+        Returns:
+          None
+    '''
+    print(f"Elapsed time: {elapsed}")
+    for key in sorted(COUNT):
+        print(f"{key + ':' : <21} {COUNT[key]:,}")
+    if STAGE:
+        print('Stage timing:')
+        for key, stat in sorted(STAGE.items()):
+            text = f"  {key + ':' : <21} {stat['count']:,} in {stat['seconds']:,.2f}sec " \
+                   + f"({stat['seconds'] / stat['count'] * 1000:,.2f}ms each)"
+            if stat['bytes'] and stat['seconds']:
+                text += f", {stat['bytes'] / stat['seconds'] / 1024 ** 2:,.2f}MB/sec"
+            print(text)
+    if VARIANT_UPLOADS:
+        print('Uploaded variants:')
+        for key in sorted(VARIANT_UPLOADS):
+            print(f"  {key + ':' : <21} {VARIANT_UPLOADS[key]:,}")
+    if ARG.LIBRARY.startswith('flylight') and len(RELPUB):
+        print("Release counts:")
+        maxlen = 0
+        for key in RELPUB:
+            maxlen = max(maxlen, len(key))
+        for key, val in sorted(RELPUB.items()):
+            print(f"{key+':':<{maxlen+1}} {val:,}")
 
 
 def update_library_config():
@@ -1264,6 +3431,10 @@ def update_library_config():
         Returns:
           None
     '''
+    if 'SHARD' in CONF:
+        # Each shard only has its own counts, so --merge updates the status
+        write_shard_counts()
+        return
     if ARG.WRITE or ARG.CONFIG:
         method = "MongoDB"
         source = "neuronMetadata"
@@ -1285,99 +3456,169 @@ def update_library_config():
             LOGGER.error("Could not update status in cdmLibraryStatus")
 
 
-if __name__ == '__main__':
-    PARSER = argparse.ArgumentParser(
+def main():
+    ''' Parse the arguments and run the program
+        Keyword arguments:
+          None
+        Returns:
+          None
+    '''
+    global ARG, AWS, CLOAD, ERR, LOGGER, REST, S3CP, STAMP # pylint: disable=W0603
+    parser = argparse.ArgumentParser(
         description="Upload Color Depth MIPs to AWS S3")
-    PARSER.add_argument('--manifest', dest='MANIFEST', action='store',
+    parser.add_argument('--manifest', dest='MANIFEST', action='store',
                         default='', help='Manifest file')
-    PARSER.add_argument('--library', dest='LIBRARY', action='store',
+    parser.add_argument('--library', dest='LIBRARY', action='store',
                         default='', help='color depth library')
-    PARSER.add_argument('--tag', dest='TAG', action='store',
+    parser.add_argument('--batch', dest='BATCH', action='store',
+                        default='', help='File of libraries to process, one per line ' \
+                                         + '(library alignment [tag|-] [variant,...]); ' \
+                                         + 'requires --manifold, and runs without confirmation')
+    parser.add_argument('--tag', dest='TAG', action='store',
                         default='', help='MongoDB neuronMetadata tag')
-    PARSER.add_argument('--release', dest='RELEASE', action='store',
+    parser.add_argument('--release', dest='RELEASE', action='store',
                         default='', help='ALPS release')
-    PARSER.add_argument('--neuronbridge', dest='NEURONBRIDGE', action='store',
+    parser.add_argument('--neuronbridge', dest='NEURONBRIDGE', action='store',
                         help='NeuronBridge version')
-    PARSER.add_argument('--dataset', dest='DATASET', action='store',
+    parser.add_argument('--dataset', dest='DATASET', action='store',
                         help='NeuPrint dataset, e.g. vnc:v0.6')
-    PARSER.add_argument('--alignment', dest='ALIGNMENT', action='store',
+    parser.add_argument('--alignment', dest='ALIGNMENT', action='store',
                         help='alignment space')
-    PARSER.add_argument('--backcheck', dest='BACKCHECK', action='store_true',
+    parser.add_argument('--backcheck', dest='BACKCHECK', action='store_true',
                         default=False, help='Perform publishing database backcheck and exit')
-    PARSER.add_argument('--internal', dest='INTERNAL', action='store_true',
+    parser.add_argument('--internal', dest='INTERNAL', action='store_true',
                         default=False, help='Upload to internal bucket')
-    PARSER.add_argument('--gamma', dest='GAMMA', action='store',
+    parser.add_argument('--gamma', dest='GAMMA', action='store',
                         default='gamma1_4', help='Variant key for gamma image to replace cdmPath')
-    PARSER.add_argument('--rewrite', dest='REWRITE', action='store_true',
+    parser.add_argument('--rewrite', dest='REWRITE', action='store_true',
                         default=False,
                         help='Flag, Update image in AWS and on JACS')
-    PARSER.add_argument('--aws', dest='AWS', action='store_true',
+    parser.add_argument('--aws', dest='AWS', action='store_true',
                         default=False, help='Write files to AWS')
-    PARSER.add_argument('--config', dest='CONFIG', action='store_true',
+    parser.add_argument('--workers', dest='WORKERS', action='store', type=int,
+                        default=8, help='Number of concurrent S3 upload workers')
+    parser.add_argument('--endpoint', dest='ENDPOINT', action='store',
+                        default='', help='Alternate S3 endpoint URL (e.g. MinIO or moto)')
+    parser.add_argument('--converters', dest='CONVERTERS', action='store', type=int,
+                        default=os.cpu_count(), help='Number of PNG conversion processes')
+    parser.add_argument('--buffer-limit', dest='BUFFER_LIMIT', action='store', type=float,
+                        default=64, help='Largest converted image (MB) to upload from memory ' \
+                                         + '(0 to always use the temp directory)')
+    parser.add_argument('--mongo-batch', dest='MONGO_BATCH', action='store', type=int,
+                        default=1000, help='Number of publishedURL upserts per bulk write')
+    parser.add_argument('--mongo-writers', dest='MONGO_WRITERS', action='store', type=int,
+                        default=2, help='Number of publishedURL bulk writes in flight')
+    parser.add_argument('--prefetch', dest='PREFETCH', action='store', type=int,
+                        default=2000, help='Number of neuronMetadata documents read ahead ' \
+                                           + '(0 to read them in the main loop)')
+    parser.add_argument('--journal', dest='JOURNAL', action='store',
+                        default='', help='Checkpoint journal file')
+    parser.add_argument('--resume', dest='RESUME', action='store_true',
+                        default=False, help='Resume from the checkpoint journal')
+    parser.add_argument('--digest-cache', dest='DIGEST_CACHE', action='store',
+                        default='', help='Cache of uploaded files, used to skip unchanged files')
+    parser.add_argument('--name-store', dest='NAME_STORE', action='store',
+                        default='', help='Disk-backed store for uploaded object names ' \
+                                         + '(bounds memory on very large libraries)')
+    parser.add_argument('--subdivision-bytes', dest='SUBDIVISION_BYTES', action='store',
+                        type=float, default=0,
+                        help='Target size (MB) of searchable_neurons subdivisions ' \
+                             + '(0 for 100 objects per subdivision)')
+    parser.add_argument('--packing', dest='PACKING', action='store',
+                        default='', help='File recording searchable_neurons subdivisions ' \
+                                         + '(reused on reruns)')
+    parser.add_argument('--compress', dest='COMPRESS', action='store_true',
+                        default=False, help='Flag, gzip the JSON and key output files')
+    parser.add_argument('--shard', dest='SHARD', action='store',
+                        default='', help='Process one shard (i/n) of the library')
+    parser.add_argument('--merge', dest='MERGE', action='store_true',
+                        default=False, help='Flag, merge the output files from a sharded run ' \
+                                            + '(and update the library status with ' \
+                                            + '--write or --config)')
+    parser.add_argument('--thumbnails', dest='THUMBNAILS', action='store_true',
+                        default=False, help='Flag, Generate and upload CDM thumbnails')
+    parser.add_argument('--thumbnail-width', dest='THUMBNAIL_WIDTH', action='store', type=int,
+                        default=THUMBNAIL_WIDTH, help='Thumbnail width and height (pixels)')
+    parser.add_argument('--thumbnail-quality', dest='THUMBNAIL_QUALITY', action='store',
+                        type=int, default=THUMBNAIL_QUALITY, help='Thumbnail JPEG quality (1-95)')
+    parser.add_argument('--validate', dest='VALIDATE', action='store_true',
+                        default=False, help='Flag, Check source image headers before processing')
+    parser.add_argument('--plan', dest='PLAN', action='store',
+                        default='', help='Write an upload plan to this file instead of uploading')
+    parser.add_argument('--execute', dest='EXECUTE', action='store',
+                        default='', help='Execute an upload plan file')
+    parser.add_argument('--metrics', dest='METRICS', action='store',
+                        default='', help='Write stage metrics to this path (.json and .prom)')
+    parser.add_argument('--metrics-interval', dest='METRICS_INTERVAL', action='store',
+                        type=float, default=60, help='Seconds between metrics updates')
+    parser.add_argument('--variants', dest='VARIANTS', action='store',
+                        default='', help='Comma-separated image types to upload ' \
+                                         + '(instead of asking)')
+    parser.add_argument('--yes', dest='YES', action='store_true',
+                        default=False, help='Flag, Run without asking for confirmation')
+    parser.add_argument('--config', dest='CONFIG', action='store_true',
                         default=False, help='Update configuration')
-    PARSER.add_argument('--published', dest='PUBLISHED', action='store',
+    parser.add_argument('--published', dest='PUBLISHED', action='store',
                         help='publishedName')
-    PARSER.add_argument('--slide', dest='SLIDE', action='store',
+    parser.add_argument('--slide', dest='SLIDE', action='store',
                         help='slideCode')
-    PARSER.add_argument('--samples', dest='SAMPLES', action='store', type=int,
+    parser.add_argument('--samples', dest='SAMPLES', action='store', type=int,
                         default=0, help='Number of samples to transfer')
-    PARSER.add_argument('--version', dest='VERSION', action='store',
+    parser.add_argument('--version', dest='VERSION', action='store',
                         default='1.0', help='EM hemibrain version (legacy)')
-    PARSER.add_argument('--manifold', dest='MANIFOLD', action='store',
+    parser.add_argument('--manifold', dest='MANIFOLD', action='store',
                         choices=MANIFOLDS, help='S3 manifold')
-    PARSER.add_argument('--mongo', dest='MONGO', action='store',
+    parser.add_argument('--mongo', dest='MONGO', action='store',
                         default='prod', choices=['dev', 'prod'],
                         help='MongoDB manifold [dev, prod]')
-    PARSER.add_argument('--neuprint', dest='NEUPRINT', action='store',
+    parser.add_argument('--neuprint', dest='NEUPRINT', action='store',
                         help='Optional non-prod NeuPrint manifold')
-    PARSER.add_argument('--mysql', dest='MYSQL', action='store',
+    parser.add_argument('--mysql', dest='MYSQL', action='store',
                         default='prod', choices=['staging', 'prod'],
                         help='MySQL manifold [staging, prod]')
-    PARSER.add_argument('--write', dest='WRITE', action='store_true',
+    parser.add_argument('--write', dest='WRITE', action='store_true',
                         default=False,
                         help='Flag, Actually write to JACS (and AWS if flag set)')
-    PARSER.add_argument('--verbose', dest='VERBOSE', action='store_true',
+    parser.add_argument('--verbose', dest='VERBOSE', action='store_true',
                         default=False, help='Flag, Chatty')
-    PARSER.add_argument('--debug', dest='DEBUG', action='store_true',
+    parser.add_argument('--debug', dest='DEBUG', action='store_true',
                         default=False, help='Flag, Very chatty')
-    ARG = PARSER.parse_args()
+    ARG = parser.parse_args()
     LOGGER = JRC.setup_logging(ARG)
     S3CP = ERR = ''
+    STAMP = strftime("%Y%m%dT%H%M%S")
+    if ARG.MERGE:
+        if not ARG.LIBRARY:
+            terminate_program("--merge requires --library")
+        set_output_files()
+        ERR = open(ERR_FILE, 'w', encoding='ascii')
+        S3CP = open(S3CP_FILE, 'w', encoding='ascii')
+        merge_shards()
+        terminate_program()
+    check_arguments()
     REST = create_config_object("rest_services")
     AWS = create_config_object("aws")
     CLOAD = create_config_object("upload_cdms")
-    initialize_program()
-    STAMP = strftime("%Y%m%dT%H%M%S")
-    ERR_FILE = f"{ARG.LIBRARY}_errors_{STAMP}.txt"
+    if ARG.EXECUTE:
+        initialize_execute()
+    else:
+        initialize_program()
+    if ARG.BATCH:
+        run_batch()
+        terminate_program()
+    set_output_files()
     ERR = open(ERR_FILE, 'w', encoding='ascii')
-    S3CP_FILE = f"{ARG.LIBRARY}_s3cp_{STAMP}.txt"
     S3CP = open(S3CP_FILE, 'w', encoding='ascii')
-    NAMES_FILE = f"{ARG.LIBRARY}_{STAMP}.names"
-    if ARG.RELEASE:
-        JSONO_FILE = f"{ARG.LIBRARY}_{ARG.RELEASE}_{STAMP}.json"
+    start_time = datetime.now()
+    if ARG.EXECUTE:
+        execute_plan()
     else:
-        JSONO_FILE = f"{ARG.LIBRARY}_{STAMP}.json"
-    START_TIME = datetime.now()
-    upload_cdms()
-    STOP_TIME = datetime.now()
+        upload_cdms()
+    stop_time = datetime.now()
     update_library_config()
-    if KEY_LIST:
-        LOGGER.info("Writing key file")
-        KEY_FILE = f"{ARG.LIBRARY}_keys_{STAMP}.txt"
-        with open(KEY_FILE, 'w', encoding='ascii') as keyfile:
-            keyfile.write(f"{json.dumps(KEY_LIST)}\n")
-    print(f"Elapsed time: {STOP_TIME - START_TIME}")
-    for key in sorted(COUNT):
-        print(f"{key + ':' : <21} {COUNT[key]:,}")
-    if VARIANT_UPLOADS:
-        print('Uploaded variants:')
-        for key in sorted(VARIANT_UPLOADS):
-            print(f"  {key + ':' : <21} {VARIANT_UPLOADS[key]:,}")
-    if ARG.LIBRARY.startswith('flylight') and len(RELPUB):
-        print("Release counts:")
-        MAXLEN = 0
-        for key in RELPUB:
-            MAXLEN = max(MAXLEN, len(key))
-        for key, val in sorted(RELPUB.items()):
-            print(f"{key+':':<{MAXLEN+1}} {val:,}")
+    print_summary(stop_time - start_time)
     terminate_program()
+
+
+if __name__ == '__main__':
+    main()